@@ -0,0 +1,95 @@
+# coding:utf-8
+"""
+小文件打包。
+小文件逐个传输时每个文件都要经过握手、确认及摘要检查的往返，传输速度受时延限制。
+发送端将多个小文件连同索引拼接为一个打包流，按普通文件分块传输、续传及校验，接收端校验通过后按索引拆出各文件。
+打包流格式：4字节索引长度 + JSON索引[[相对路径, 长度, 权限], ...] + 各文件内容
+"""
+import hashlib
+import json
+import os
+
+import manifest
+
+SUFFIX = '.ftbundle'
+FILE_MAX = 65536  # 不超过此大小的文件打包发送(字节)
+BUNDLE_MAX = 4194304  # 单个打包流中文件内容的总长度上限(字节)
+FILES_MAX = 1024  # 单个打包流中的文件数上限
+
+
+def grouper(files):
+    """
+    将(路径, 相对路径)列表中的小文件分组，返回单独发送的文件与小文件列表混合的列表。
+    各组排在组内首个文件的位置，只有一个文件的组仍单独发送；无法读取大小的文件单独发送，由其传输报告错误
+    """
+    result, group, size = [], [], 0
+    for item in files:
+        try:
+            length = os.path.getsize(item[0])
+        except OSError:
+            length = None
+        if length is None or length > FILE_MAX:
+            result.append(item)
+            continue
+        if not group or size + length > BUNDLE_MAX or len(group) >= FILES_MAX:
+            group, size = [], 0
+            result.append(group)
+        group.append(item)
+        size += length
+    return [item[0] if isinstance(item, list) and len(item) == 1 else item for item in result]
+
+
+class Bundle:
+    """打包流类，以文件对象的seek/read接口按偏移读取索引及各文件内容。"""
+
+    def __init__(self, files):
+        self.paths = [path for path, name in files]
+        self.sizes = [os.path.getsize(path) for path in self.paths]
+        index = json.dumps([[name, size, manifest.mode_of(path)]
+                            for (path, name), size in zip(files, self.sizes)]).encode()
+        self.head = len(index).to_bytes(4, 'big') + index
+        self.size = len(self.head) + sum(self.sizes)
+        self.name = '.' + hashlib.md5(self.head).hexdigest() + SUFFIX  # 同一组文件的打包流同名，可续传
+        # 打包流指纹：索引及各文件的修改时间，文件修改后不再续传
+        self.key = hashlib.md5(self.head + str([os.path.getmtime(path) for path in self.paths]).encode()).hexdigest()
+        self.offset = 0
+
+    def seek(self, offset):
+        self.offset = offset
+
+    def read(self, size=-1):
+        end = self.size if size < 0 else min(self.offset + size, self.size)
+        data = bytearray(self.head[self.offset:end])
+        start = len(self.head)
+        for path, length in zip(self.paths, self.sizes):
+            if self.offset < start + length and start < end:
+                with open(path, 'rb') as f:
+                    f.seek(max(self.offset - start, 0))
+                    data += f.read(min(end, start + length) - max(self.offset, start))
+            start += length
+        self.offset = end
+        return bytes(data)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def extract(path, save_dir, renamer):
+    """按索引将打包流中的文件写入save_dir并设置权限，renamer将相对路径转为不重名的本地路径，返回相对路径列表。"""
+    names = []
+    with open(path, 'rb') as f:
+        index = json.loads(f.read(int.from_bytes(f.read(4), 'big')))
+        for name, length, mode in index:
+            target = os.path.join(save_dir, renamer(name))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as out:
+                out.write(f.read(length))
+            os.chmod(target, mode)
+            names.append(name)
+    return names
@@ -1,9 +1,10 @@
 # coding:utf-8
 """UDP聊天客户端。"""
 import asyncio
-import json
 import random
 
+import packet
+
 
 class ClientProtocol(asyncio.DatagramProtocol):
     """聊天客户端主控制类。"""
@@ -20,12 +21,15 @@ class ClientProtocol(asyncio.DatagramProtocol):
     def connection_made(self, transport):
         """连接建立并发送消息，5s内消息未发送则归为发送失败。"""
         self.transport = transport
-        cdata = json.dumps({'type': 'chat', 'message': self.message}).encode()
+        cdata = packet.pack_control({'type': 'chat', 'message': self.message}, 0, self.loop.time(), 0.0, 0.0)
         self.timer = self.loop.call_later(5, self.on_con_lost.set_result, True)
         self.chat_sender(cdata)
 
-    def datagram_received(self, message, addr):
-        message = json.loads(message)
+    def datagram_received(self, data, addr):
+        if packet.version_of(data) != packet.VERSION or not packet.intact(data):  # 忽略不兼容及损坏的数据报
+            return
+        header, payload = packet.unpack(data)
+        message = packet.message_of(payload)
         if message['type'] == 'chat':
             if message['data'] == 'get' and message['message'] == self.message:
                 self.time_counter.cancel()
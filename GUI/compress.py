@@ -0,0 +1,117 @@
+# coding:utf-8
+"""
+分块压缩。
+发送端在握手消息中列出可用的压缩算法，接收端在握手回包中选定其一，此后发送端逐块压缩，压缩有效的分块在头部加上标志。
+压缩在线程池中提前进行，不阻塞事件循环；每块先试压一段样本，压缩率不足(已压缩的媒体等高熵数据)时原样发送，
+连续多块无效时其后若干块不再尝试。zstd需要安装zstandard，否则只使用zlib
+"""
+import collections
+import concurrent.futures
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SAMPLE_SIZE = 4096  # 试压样本长度(字节)
+SAMPLE_RATIO = 0.9  # 样本压缩后超过原长度的此比例时不压缩整块
+MISS_LIMIT = 8  # 连续压缩无效的分块数达到此值时暂停压缩
+SKIP_SPAN = 64  # 暂停压缩的分块数
+AHEAD_MAX = 64  # 提前压缩的分块数上限
+
+POOL = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())  # 压缩线程池，线程按需创建
+
+
+def zlib_unpacker(data, size):
+    """以zlib解压，解压后超过size字节或数据不完整时抛出ValueError。"""
+    decompressor = zlib.decompressobj()
+    result = decompressor.decompress(data, size)
+    if not decompressor.eof or decompressor.unconsumed_tail:
+        raise ValueError('压缩分块不完整或过长')
+    return result
+
+
+# {算法: (压缩函数, 解压函数)}，按优先顺序排列
+CODECS = {'zlib': (lambda data, level: zlib.compress(data, level), zlib_unpacker)}
+if zstandard:
+    CODECS = {'zstd': (lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+                       lambda data, size: zstandard.ZstdDecompressor().decompress(data, max_output_size=size)),
+              **CODECS}
+
+
+def chooser(codecs):
+    """接收端从发送端列出的算法中选出本地可用的第一个，没有返回None。"""
+    return next((codec for codec in codecs if codec in CODECS), None)
+
+
+def pack(codec, level, data):
+    """压缩分块，样本或整块压缩无效时返回None。"""
+    compressor = CODECS[codec][0]
+    if len(data) > 2 * SAMPLE_SIZE and len(compressor(data[:SAMPLE_SIZE], 1)) > SAMPLE_SIZE * SAMPLE_RATIO:
+        return None
+    packed = compressor(data, level)
+    return packed if len(packed) < len(data) else None
+
+
+def unpack(codec, data, size):
+    """解压分块，解压后不超过size字节；算法未协商或数据损坏时抛出ValueError。"""
+    if codec not in CODECS:
+        raise ValueError('未协商压缩算法')
+    try:
+        return CODECS[codec][1](data, size)
+    except (zlib.error, getattr(zstandard, 'ZstdError', zlib.error)) as e:
+        raise ValueError(repr(e))
+
+
+class Pipeline:
+    """
+    压缩流水线，按序迭代分块生成器给出的分块，压缩有效的分块的数据替换为压缩数据并加上标志。
+    取出前须调用waiting：队首尚未压缩完成时返回True，并在完成后调用waker
+    """
+
+    def __init__(self, parts, codec, level, flag):
+        self.parts = parts  # 分块生成器
+        self.codec = codec
+        self.level = level
+        self.flag = flag  # 压缩分块的头部标志
+        self.queue = collections.deque()  # 已读取的分块：[(分块, future), ...]，future为None时不压缩
+        self.misses = 0  # 连续压缩无效的分块数
+        self.skip = 0  # 剩余暂停压缩的分块数
+        self.notified = None  # 已登记waker的future
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        part, future = self.queue.popleft() if self.queue else (next(self.parts), None)
+        packed = future.result() if future else None
+        if packed is not None:
+            part.data, part.flags = packed, self.flag
+            self.misses = 0
+        elif future:
+            self.misses += 1
+            if self.misses >= MISS_LIMIT:
+                self.misses, self.skip = 0, SKIP_SPAN
+        return part
+
+    def waiting(self, ahead, waker):
+        """提前读取并提交至多ahead个分块的压缩，返回队首是否尚未压缩完成。"""
+        ahead = min(max(ahead, 1), AHEAD_MAX)
+        while len(self.queue) < ahead:
+            part = next(self.parts, None)
+            if part is None:
+                break
+            if self.skip:
+                self.skip -= 1
+                self.queue.append((part, None))
+            else:
+                self.queue.append((part, POOL.submit(pack, self.codec, self.level, part.data)))
+        future = self.queue[0][1] if self.queue else None
+        if not future or future.done():
+            return False
+        if future is not self.notified:
+            self.notified = future
+            future.add_done_callback(lambda f: waker())
+        return True
@@ -0,0 +1,114 @@
+# coding:utf-8
+"""
+拥塞控制及发送节拍。
+控制器只维护拥塞窗口(分块数)，由发送端在确认、丢包时调用；
+节拍器按窗口与往返时延换算出的速率均匀放出数据报。
+"""
+
+WINDOW_INIT = 2.0  # 初始窗口(分块数)
+WINDOW_MIN = 2.0  # 窗口下限(分块数)
+WINDOW_LIMIT = 4194304  # 自动窗口的上限(字节)，按分块大小换算为分块数
+PACING_GAIN = 1.25  # 发送速率相对窗口/往返时延的增益，留出余量以便窗口能被填满
+PACING_BURST = 2  # 空闲后允许连续放出的分块数
+
+
+class FixedController:
+    """固定窗口，不随网络状况调整。"""
+
+    def __init__(self, window):
+        self.cwnd = float(window)
+
+    def on_ack(self, acked, rtt):
+        """有acked个分块被确认。"""
+        pass
+
+    def on_loss(self):
+        """一轮丢包(快速重发或超时)。"""
+        pass
+
+    def interval(self, rtt):
+        """返回相邻两个分块的发送间隔(秒)，尚无往返时延样本时不限速。"""
+        if rtt.srtt is None:
+            return 0.0
+        return rtt.srtt / (self.cwnd * PACING_GAIN)
+
+
+class AimdController(FixedController):
+    """加性增、乘性减：慢启动翻倍至阈值后每轮加一，丢包时减半。"""
+
+    def __init__(self, limit, window=WINDOW_INIT):
+        super().__init__(window)
+        self.limit = limit  # 窗口上限(分块数)
+        self.ssthresh = limit  # 慢启动阈值
+
+    def on_ack(self, acked, rtt):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, self.limit)
+
+    def on_loss(self):
+        self.ssthresh = max(self.cwnd / 2, WINDOW_MIN)
+        self.cwnd = self.ssthresh
+
+
+class DelayController(FixedController):
+    """
+    基于时延的控制(Vegas)：以最小往返时延为基准估计在瓶颈处排队的分块数，
+    少于ALPHA时加窗，多于BETA时减窗，使排队维持在很小的范围内。
+    """
+    ALPHA = 2  # 排队分块数下限
+    BETA = 4  # 排队分块数上限
+    GAMMA = 1  # 慢启动阶段允许的排队分块数
+
+    def __init__(self, limit, window=WINDOW_INIT):
+        super().__init__(window)
+        self.limit = limit  # 窗口上限(分块数)
+        self.slow_start = True
+
+    def on_ack(self, acked, rtt):
+        if not rtt.srtt:
+            return
+        queued = self.cwnd * (rtt.srtt - rtt.min_rtt) / rtt.srtt
+        if self.slow_start:
+            if queued < self.GAMMA:
+                self.cwnd += acked
+            else:
+                self.slow_start = False
+        elif queued < self.ALPHA:
+            self.cwnd += acked / self.cwnd
+        elif queued > self.BETA:
+            self.cwnd -= acked / self.cwnd
+        self.cwnd = min(max(self.cwnd, WINDOW_MIN), self.limit)
+
+    def on_loss(self):
+        # 拥塞主要由时延感知，丢包时只小幅减窗，避免随机丢包链路上吞吐量骤降
+        self.slow_start = False
+        self.cwnd = max(self.cwnd * 0.75, WINDOW_MIN)
+
+
+CONTROLLERS = {'aimd': AimdController, 'delay': DelayController}
+
+
+def controller(name, window, chunk):
+    """按名称创建拥塞控制器，window不为0时使用固定窗口，chunk为分块大小(字节)。"""
+    if window:
+        return FixedController(window)
+    return CONTROLLERS[name](max(WINDOW_LIMIT // chunk, WINDOW_MIN))
+
+
+class Pacer:
+    """发送节拍器：记录下一个分块允许发送的时间。"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.next_at = 0.0
+
+    def delay(self):
+        """距离下一次允许发送的时间(秒)，不大于0时可立即发送。"""
+        return self.next_at - self.loop.time()
+
+    def sent(self, interval):
+        """发送一个分块后推后下一次允许发送的时间，空闲后最多积攒PACING_BURST个分块的额度。"""
+        self.next_at = max(self.next_at, self.loop.time() - PACING_BURST * interval) + interval
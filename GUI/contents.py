@@ -0,0 +1,89 @@
+# coding:utf-8
+"""
+内容索引。
+接收端记录校验通过的文件的(大小, 分段长度, 摘要)及相对路径，保存在保存目录下的索引文件中；
+发送端在握手消息中附带文件摘要，命中时接收端在本地复制一份该文件，不再传输数据。
+索引文件每行一条JSON记录，追加写入，载入时去掉已删除或修改过的文件并重写；
+多进程接收时各进程共用索引文件，查找不到时读入其余进程追加的记录
+"""
+import json
+import os
+import threading
+
+INDEX = '.ftindex'
+
+
+class ContentIndex:
+    """内容索引类，校验线程添加记录，事件循环查找。"""
+
+    def __init__(self, save_dir, compact=True):
+        self.save_dir = save_dir
+        self.path = os.path.join(save_dir, INDEX)
+        self.entries = {}  # {(size, segment, digest): (相对路径, 修改时间)}
+        self.offset = 0  # 已读入的索引文件长度
+        self.lock = threading.Lock()
+        self.refresh()
+        if not compact:  # 多进程接收时只由启动进程整理索引文件
+            return
+        self.entries = {key: value for key, value in self.entries.items() if self.valid(key, *value)}
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                for key, value in self.entries.items():
+                    f.write(json.dumps([*key, *value]) + '\n')
+                self.offset = f.tell()
+        except OSError:
+            pass
+
+    def refresh(self):
+        """读入索引文件中新追加的完整记录。"""
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return
+        end = data.rfind(b'\n') + 1  # 末行可能正在写入
+        self.offset += end
+        for line in data[:end].splitlines():
+            try:
+                size, segment, digest, name, mtime = json.loads(line)
+            except ValueError:  # 写入中断的行
+                continue
+            self.entries[(size, segment, digest)] = (name, mtime)
+
+    def valid(self, key, name, mtime):
+        """判断记录的文件是否仍存在且未被修改。"""
+        try:
+            stat = os.stat(os.path.join(self.save_dir, name))
+        except OSError:
+            return False
+        return stat.st_size == key[0] and stat.st_mtime == mtime
+
+    def add(self, size, segment, digest, path):
+        """记录校验通过的文件，可在校验线程中调用。"""
+        name = os.path.relpath(path, self.save_dir)
+        key, value = (size, segment, digest), (name, os.stat(path).st_mtime)
+        with self.lock:
+            self.entries[key] = value
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps([*key, *value]) + '\n')
+            except OSError:
+                pass
+
+    def discard(self, size, segment, digest):
+        """去掉无法复制的文件的记录，此后同一内容照常传输。"""
+        with self.lock:
+            self.entries.pop((size, segment, digest), None)
+
+    def find(self, size, segment, digest):
+        """返回内容相同的文件路径，没有或文件已被修改时返回None。"""
+        key = (size, segment, digest)
+        with self.lock:
+            if key not in self.entries:
+                self.refresh()
+            value = self.entries.get(key)
+            if value and not self.valid(key, *value):
+                self.entries.pop(key)
+                value = None
+        return os.path.join(self.save_dir, value[0]) if value else None
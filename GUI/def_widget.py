@@ -1,9 +1,10 @@
 # coding:utf-8
 """自定义QT控件集"""
 import os
+import socket
 
 from PyQt5.QtCore import Qt, QSettings
-from PyQt5.QtWidgets import QMessageBox, QSpinBox, QCheckBox, QGroupBox, QDoubleSpinBox
+from PyQt5.QtWidgets import QMessageBox, QSpinBox, QCheckBox, QGroupBox, QDoubleSpinBox, QComboBox
 from PyQt5.QtWidgets import QPushButton, QLabel, QFileDialog, QLineEdit, QTextEdit, QMenu
 from PyQt5.QtWidgets import QWidget, QFormLayout, QHBoxLayout, QVBoxLayout
 
@@ -107,11 +108,72 @@ class ClientSettingDialog(QWidget):
 
         self.Lfile_num = QLabel('同时传输的文件数  ')
         self.Sfile_num = QSpinBox(self)
-        self.Sfile_num.setRange(1, 3)
+        self.Sfile_num.setRange(1, 16)
         self.Sfile_num.setWrapping(True)
         self.Sfile_num.setContextMenuPolicy(Qt.NoContextMenu)
         setting_file_num = int(self.settings.value('file_at_same_time', 2))
         self.Sfile_num.setValue(setting_file_num)
+        self.Lwindow = QLabel('发送窗口(分块数)')
+        self.Swindow = QSpinBox(self)
+        self.Swindow.setRange(0, 256)
+        self.Swindow.setSpecialValueText('自动')
+        self.Swindow.setContextMenuPolicy(Qt.NoContextMenu)
+        setting_window = int(self.settings.value('window', 0))
+        self.Swindow.setValue(setting_window)
+        self.Lcongestion = QLabel('拥塞控制(自动窗口)')
+        self.Ccongestion = QComboBox(self)
+        self.Ccongestion.addItem('AIMD', 'aimd')
+        self.Ccongestion.addItem('时延(Vegas)', 'delay')
+        setting_congestion = self.settings.value('congestion', 'aimd')
+        self.Ccongestion.setCurrentIndex(max(self.Ccongestion.findData(setting_congestion), 0))
+        self.Lchunk = QLabel('分块大小(字节)')
+        self.Schunk = QSpinBox(self)
+        self.Schunk.setRange(0, 65000)
+        self.Schunk.setSingleStep(500)
+        self.Schunk.setSpecialValueText('自动(探测路径MTU)')
+        self.Schunk.setContextMenuPolicy(Qt.NoContextMenu)
+        setting_chunk = int(self.settings.value('chunk', 0))
+        self.Schunk.setValue(setting_chunk)
+        self.Lverify = QLabel('完整性校验')
+        self.Cverify = QComboBox(self)
+        self.Cverify.addItem('MD5', 'md5')
+        self.Cverify.addItem('分段树形哈希(多核)', 'tree')
+        setting_verify = self.settings.value('verify', 'md5')
+        self.Cverify.setCurrentIndex(max(self.Cverify.findData(setting_verify), 0))
+        self.Lcompress = QLabel('压缩级别')
+        self.Scompress = QSpinBox(self)
+        self.Scompress.setRange(0, 9)
+        self.Scompress.setSpecialValueText('不压缩')
+        self.Scompress.setContextMenuPolicy(Qt.NoContextMenu)
+        setting_compress = int(self.settings.value('compress', 0))
+        self.Scompress.setValue(setting_compress)
+        self.Lfec = QLabel('前向纠错(有丢包的链路)')
+        self.Cfec = QComboBox(self)
+        self.Cfec.addItem('关闭', 0)
+        self.Cfec.addItem('自动(按丢包率)', -1)
+        self.Cfec.addItem('每组1个校验块', 1)
+        self.Cfec.addItem('每组2个校验块', 2)
+        self.Cfec.addItem('每组4个校验块', 4)
+        setting_fec = int(self.settings.value('fec', 0))
+        self.Cfec.setCurrentIndex(max(self.Cfec.findData(setting_fec), 0))
+        self.Lstripes = QLabel('每个文件的套接字数')
+        self.Sstripes = QSpinBox(self)
+        self.Sstripes.setRange(1, 8)
+        self.Sstripes.setContextMenuPolicy(Qt.NoContextMenu)
+        setting_stripes = int(self.settings.value('stripes', 1))
+        self.Sstripes.setValue(setting_stripes)
+        self.Lbundle = QLabel('打包发送小文件')
+        self.Cbundle = QCheckBox(self)
+        setting_bundle = int(self.settings.value('bundle', True))
+        self.Cbundle.setChecked(setting_bundle)
+        self.Ldelta = QLabel('差异传输(接收端有旧版本时)')
+        self.Cdelta = QCheckBox(self)
+        setting_delta = int(self.settings.value('delta', False))
+        self.Cdelta.setChecked(setting_delta)
+        self.Ldedup = QLabel('跳过接收端已有的相同内容(先读一遍文件)')
+        self.Cdedup = QCheckBox(self)
+        setting_dedup = int(self.settings.value('dedup', False))
+        self.Cdedup.setChecked(setting_dedup)
         self.Ldel_source = QLabel('完成后删除源文件')
         self.Cdel_source = QCheckBox(self)
         setting_del_source = int(self.settings.value('del_source', False))
@@ -131,6 +193,16 @@ class ClientSettingDialog(QWidget):
         trans_form = QFormLayout()
         trans_form.setSpacing(10)
         trans_form.addRow(self.Lfile_num, self.Sfile_num)
+        trans_form.addRow(self.Lwindow, self.Swindow)
+        trans_form.addRow(self.Lcongestion, self.Ccongestion)
+        trans_form.addRow(self.Lchunk, self.Schunk)
+        trans_form.addRow(self.Lverify, self.Cverify)
+        trans_form.addRow(self.Lcompress, self.Scompress)
+        trans_form.addRow(self.Lfec, self.Cfec)
+        trans_form.addRow(self.Lstripes, self.Sstripes)
+        trans_form.addRow(self.Lbundle, self.Cbundle)
+        trans_form.addRow(self.Ldelta, self.Cdelta)
+        trans_form.addRow(self.Ldedup, self.Cdedup)
         trans_form.addRow(self.Ldel_timeout, self.Sdel_timeout)
         trans_form.addRow(self.Ldel_source, self.Cdel_source)
         self.Gtrans.setLayout(trans_form)
@@ -174,6 +246,16 @@ class ClientSettingDialog(QWidget):
             self.settings.setValue('host', self.Eserver_ip.text())
             self.settings.setValue('server_port', self.Sserver_port.value())
             self.settings.setValue('file_at_same_time', self.Sfile_num.value())
+            self.settings.setValue('window', self.Swindow.value())
+            self.settings.setValue('congestion', self.Ccongestion.currentData())
+            self.settings.setValue('chunk', self.Schunk.value())
+            self.settings.setValue('verify', self.Cverify.currentData())
+            self.settings.setValue('compress', self.Scompress.value())
+            self.settings.setValue('fec', self.Cfec.currentData())
+            self.settings.setValue('stripes', self.Sstripes.value())
+            self.settings.setValue('bundle', int(self.Cbundle.isChecked()))
+            self.settings.setValue('delta', int(self.Cdelta.isChecked()))
+            self.settings.setValue('dedup', int(self.Cdedup.isChecked()))
             self.settings.setValue('del_source', int(self.Cdel_source.isChecked()))
             self.settings.setValue('del_timeout', self.Sdel_timeout.value())
             self.settings.sync()
@@ -231,6 +313,13 @@ class ServerSettingDialog(QWidget):
         self.Ereceive_dir.setContextMenuPolicy(Qt.NoContextMenu)
         setting_receive_dir = self.settings.value('receive_dir', os.path.abspath('.'))
         self.Ereceive_dir.setText(setting_receive_dir)
+        self.Lworkers = QLabel('接收进程数')
+        self.Sworkers = QSpinBox(self)
+        self.Sworkers.setRange(1, os.cpu_count() or 1)
+        self.Sworkers.setContextMenuPolicy(Qt.NoContextMenu)
+        self.Sworkers.setEnabled(hasattr(socket, 'SO_REUSEPORT'))  # 多进程共用端口需要SO_REUSEPORT
+        setting_workers = int(self.settings.value('workers', 1))
+        self.Sworkers.setValue(setting_workers)
         self.settings.endGroup()
 
         self.Gtrans = QGroupBox('传输设置')
@@ -239,6 +328,7 @@ class ServerSettingDialog(QWidget):
         trans_form.addRow(self.Lopen_server, self.Copen_server)
         trans_form.addRow(self.Lreceive_dir, self.Breceive_dir)
         trans_form.addRow(self.Ereceive_dir)
+        trans_form.addRow(self.Lworkers, self.Sworkers)
         self.Gtrans.setLayout(trans_form)
 
         self.Bconfirm = QPushButton('确定', self)
@@ -281,6 +371,7 @@ class ServerSettingDialog(QWidget):
             self.settings.setValue('bind_port', self.Sbind_port.value())
             self.settings.setValue('open_server', int(self.Copen_server.isChecked()))
             self.settings.setValue('receive_dir', self.Ereceive_dir.text())
+            self.settings.setValue('workers', self.Sworkers.value())
             self.settings.sync()
             self.settings.endGroup()
             self.close()
@@ -0,0 +1,197 @@
+# coding:utf-8
+"""
+差异传输。
+接收端已有同名的旧版本时，按分块计算其签名(可滚动的Adler-32弱校验和及截短的MD5强摘要)分页回送，
+发送端在新文件中逐块查找相同的分块，生成由分块引用及字面数据组成的差异流，按普通文件分块传输及校验，
+接收端校验通过后由旧版本及差异流重建新文件，核对整个文件的MD5后替换旧版本。
+差异流格式：b'C' + 起始分块序号(4字节) + 分块数(4字节)，或b'L' + 长度(4字节) + 字面数据
+"""
+import hashlib
+import math
+import os
+import struct
+import zlib
+
+SUFFIX = '.ftdelta'
+DELTA_MIN = 1048576  # 不小于此大小的文件才尝试差异传输(字节)
+BLOCK_MIN = 4096  # 分块长度下限(字节)
+BLOCK_MAX = 1048576  # 分块长度上限(字节)
+PAGE_BLOCKS = 256  # 每个签名消息包含的分块数
+PAGE_BURST = 16  # 每次请求的签名页数
+LITERAL_MAX = 1048576  # 字面数据累积到此长度即写出(字节)
+STRONG_SIZE = 8  # 强摘要截取的字节数
+COPY = struct.Struct('!cII')
+LITERAL = struct.Struct('!cI')
+MOD_ADLER = 65521
+
+
+def block_of(size):
+    """按旧版本的大小选取分块长度：约为大小的平方根，取1KiB的整数倍。"""
+    block = -(-int(math.isqrt(size)) // 1024) * 1024
+    return min(max(block, BLOCK_MIN), BLOCK_MAX)
+
+
+def strong_of(data):
+    return hashlib.md5(data).digest()[:STRONG_SIZE]
+
+
+def page_of(path, block, page):
+    """计算旧版本第page页各分块的签名，返回(弱校验和列表, 强摘要的十六进制串)。"""
+    weak, strong = [], []
+    with open(path, 'rb') as f:
+        f.seek(page * PAGE_BLOCKS * block)
+        for i in range(PAGE_BLOCKS):
+            data = f.read(block)
+            if len(data) < block:  # 末尾不足一块的数据不参与匹配
+                break
+            weak.append(zlib.adler32(data))
+            strong.append(strong_of(data))
+    return weak, b''.join(strong).hex()
+
+
+def pages_of(size, block):
+    """返回旧版本的签名页数。"""
+    return -(-(size // block) // PAGE_BLOCKS)
+
+
+def delta_gener(path, block, weak, strong, out):
+    """
+    由旧版本各分块的弱校验和及强摘要生成新文件的差异流并写入out，返回新文件的MD5。
+    先按块对齐比较强摘要；不匹配时在一个分块长度内滚动弱校验和寻找插入或删除后的对齐位置，
+    找不到则作为字面数据，连续不匹配的块只在第1、2、4、8…块滚动查找，完全改变的数据基本只需逐块计算摘要
+    """
+    index = {}  # {强摘要: 分块序号}
+    for i, digest in enumerate(strong):
+        index.setdefault(digest, i)
+    weak_index = {}  # {弱校验和: [分块序号, ...]}
+    for i, value in enumerate(weak):
+        weak_index.setdefault(value, []).append(i)
+    md5 = hashlib.md5()
+    ops = DeltaWriter(out)
+    with open(path, 'rb') as f:
+        data = f.read(2 * block)
+        pos = 0  # 当前分块在data中的偏移
+        misses = 0  # 连续不匹配的块数
+        while True:
+            if len(data) - pos < 2 * block:  # 保持缓冲区中至少有两个分块
+                data = data[pos:] + f.read(max(block, 1048576))
+                pos = 0
+            if len(data) - pos < block:
+                break
+            window = data[pos:pos + block]
+            match = index.get(strong_of(window))
+            if match is not None:
+                ops.copy(match)
+                md5.update(window)
+                pos += block
+                misses = 0
+                continue
+            if not misses & (misses - 1):
+                found = roller(data, pos, block, weak_index, strong)
+                if found:
+                    shift, match = found
+                    ops.literal(data[pos:pos + shift])
+                    ops.copy(match)
+                    md5.update(data[pos:pos + shift + block])
+                    pos += shift + block
+                    misses = 0
+                    continue
+            ops.literal(window)
+            md5.update(window)
+            pos += block
+            misses += 1
+        ops.literal(data[pos:])
+        md5.update(data[pos:])
+    ops.flush()
+    return md5.hexdigest()
+
+
+def roller(data, pos, block, weak_index, strong):
+    """从data[pos]起将窗口逐字节后移至多一个分块长度，返回首个匹配的(偏移, 分块序号)，没有返回None。"""
+    end = min(pos + block, len(data) - block)
+    value = zlib.adler32(data[pos:pos + block])
+    a, b = value & 0xffff, value >> 16
+    for start in range(pos, end + 1):
+        if start > pos:  # 移出data[start-1]，移入data[start+block-1]
+            out, new = data[start - 1], data[start + block - 1]
+            a = (a - out + new) % MOD_ADLER
+            b = (b - block * out + a - 1) % MOD_ADLER
+        candidates = weak_index.get(b << 16 | a)
+        if candidates:
+            digest = strong_of(data[start:start + block])
+            for i in candidates:
+                if strong[i] == digest:
+                    return start - pos, i
+    return None
+
+
+class DeltaWriter:
+    """差异流写入类，合并相邻的分块引用及字面数据。"""
+
+    def __init__(self, out):
+        self.out = out
+        self.copying = None  # 待写出的分块引用：[起始序号, 分块数]
+        self.literals = []  # 待写出的字面数据
+        self.pending = 0  # 待写出的字面数据长度
+
+    def copy(self, index):
+        if self.copying and self.copying[0] + self.copying[1] == index:
+            self.copying[1] += 1
+            return
+        self.flush()
+        self.copying = [index, 1]
+
+    def literal(self, data):
+        if not data:
+            return
+        if self.copying:
+            self.flush()
+        self.literals.append(data)
+        self.pending += len(data)
+        if self.pending >= LITERAL_MAX:
+            self.flush()
+
+    def flush(self):
+        if self.copying:
+            self.out.write(COPY.pack(b'C', *self.copying))
+            self.copying = None
+        if self.literals:
+            data = b''.join(self.literals)
+            self.out.write(LITERAL.pack(b'L', len(data)) + data)
+            self.literals = []
+            self.pending = 0
+
+
+def rebuild(stream, basis, target, block):
+    """由旧版本basis及差异流stream重建新文件写入target，返回新文件的MD5。"""
+    md5 = hashlib.md5()
+    with open(stream, 'rb') as f, open(basis, 'rb') as old, open(target, 'wb') as new:
+        while True:
+            op = f.read(1)
+            if not op:
+                break
+            if op == b'C':
+                index, count = struct.unpack('!II', f.read(8))
+                old.seek(index * block)
+                remain = count * block
+                while remain:
+                    data = old.read(min(remain, 1048576))
+                    if not data:
+                        raise ValueError('差异流引用的分块超出旧版本')
+                    md5.update(data)
+                    new.write(data)
+                    remain -= len(data)
+            elif op == b'L':
+                length, = struct.unpack('!I', f.read(4))
+                data = f.read(length)
+                md5.update(data)
+                new.write(data)
+            else:
+                raise ValueError('差异流已损坏')
+    return md5.hexdigest()
+
+
+def temp_of(path):
+    """返回重建新文件时使用的临时文件路径，与旧版本位于同一目录以便替换。"""
+    head, tail = os.path.split(path)
+    return os.path.join(head, '.' + tail + SUFFIX)
@@ -0,0 +1,131 @@
+# coding:utf-8
+"""
+前向纠错。
+发送端将连续的数据分块编为一组，发出组内末块后附发若干校验块，接收端收到组内任意n个数据块或校验块
+(n为组内数据块数)即可恢复丢失的数据块，不必等待超时重发。
+每组的分块数随发送窗口变化，使校验块在约一个往返时延内发出，赶在超时重发之前；组的位置及大小随校验块发送。
+校验块为GF(256)上的系统Reed-Solomon码：系数取自Cauchy矩阵，其任意方阵均可逆，校验块数不超过PARITY_MAX；
+各列按首行归一化，只有一个校验块时即为各数据块的异或。乘法以bytes.translate查表，加法以大整数异或，
+数据块不足分块大小时在末尾补零
+"""
+import functools
+
+GROUP = 16  # 每组数据分块数上限
+GROUP_MIN = 4  # 每组数据分块数下限
+PARITY_MAX = 4  # 每组校验块数上限
+PARITY_BASE = 128  # 校验行的Cauchy取值起点，组内序号小于此值
+MARGIN = 2  # 自动模式下校验块数为期望丢失块数的倍数
+LOSS_SAMPLE = 64  # 估计丢包率的最少发送分块数
+GROUPS_MAX = 256  # 接收端暂存的未完成分组数上限
+
+
+def tables():
+    """生成GF(256)的指数表及对数表，本原多项式为0x11d，指数表重复一周以免取模。"""
+    exp, log = [0] * 512, [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = exp[i + 255] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+    return exp, log
+
+
+EXP, LOG = tables()
+
+
+def mul(a, b):
+    return EXP[LOG[a] + LOG[b]] if a and b else 0
+
+
+def inv(a):
+    return EXP[255 - LOG[a]]
+
+
+@functools.lru_cache(maxsize=None)
+def table_of(c):
+    """返回乘以c的查找表。"""
+    return bytes(mul(c, x) for x in range(256))
+
+
+@functools.lru_cache(maxsize=None)
+def coefficient(j, i):
+    """第j个校验块中组内第i个数据块的系数：Cauchy矩阵元素除以同列首行元素，首行全为1。"""
+    return mul(inv((PARITY_BASE + j) ^ i), PARITY_BASE ^ i)
+
+
+def scaled(data, c):
+    """返回data各字节乘以c后的小端整数。"""
+    if c != 1:
+        data = bytes(data).translate(table_of(c))
+    return int.from_bytes(data, 'little')
+
+
+def group_of(cwnd):
+    """按拥塞窗口选取每组的分块数：约为半个窗口。"""
+    return min(max(int(cwnd) // 2, GROUP_MIN), GROUP)
+
+
+def parity_of(loss, group):
+    """按丢包率选取每组的校验块数。"""
+    return min(PARITY_MAX, -int(-loss * group * MARGIN // 1))
+
+
+class Encoder:
+    """一组数据分块的校验块计算类，按组内顺序输入数据块。"""
+
+    def __init__(self, parity, chunk):
+        self.sums = [0] * parity  # 各校验块的累计值
+        self.chunk = chunk
+        self.count = 0  # 已输入的数据块数
+
+    def update(self, data):
+        for j in range(len(self.sums)):
+            self.sums[j] ^= scaled(data, coefficient(j, self.count))
+        self.count += 1
+
+    def parities(self):
+        """返回[(校验序号, 校验块), ...]。"""
+        return [(j, value.to_bytes(self.chunk, 'little')) for j, value in enumerate(self.sums)]
+
+
+def inverse_of(matrix):
+    """以Gauss-Jordan消元求GF(256)上方阵的逆。"""
+    size = len(matrix)
+    rows = [row[:] + [int(i == k) for k in range(size)] for i, row in enumerate(matrix)]
+    for col in range(size):
+        pivot = next(r for r in range(col, size) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        factor = inv(rows[col][col])
+        rows[col] = [mul(factor, value) for value in rows[col]]
+        for r in range(size):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [value ^ mul(factor, pivot_value) for value, pivot_value in zip(rows[r], rows[col])]
+    return [row[size:] for row in rows]
+
+
+def decode(known, parities, count, chunk):
+    """
+    由已收的数据块{组内序号: 数据}及校验块{校验序号: 校验块}恢复组内丢失的数据块，count为组内数据块数。
+    返回{组内序号: 补零至分块大小的数据}，校验块不足时返回None
+    """
+    missing = [i for i in range(count) if i not in known]
+    rows = sorted(parities)[:len(missing)]
+    if len(rows) < len(missing):
+        return None
+    syndromes = []  # 校验块减去已收数据块的贡献，只剩丢失数据块的线性组合
+    for j in rows:
+        value = int.from_bytes(parities[j], 'little')
+        for i, data in known.items():
+            value ^= scaled(data, coefficient(j, i))
+        syndromes.append(value.to_bytes(chunk, 'little'))
+    inverse = inverse_of([[coefficient(j, i) for i in missing] for j in rows])
+    result = {}
+    for row, i in zip(inverse, missing):
+        value = 0
+        for c, syndrome in zip(row, syndromes):
+            value ^= scaled(syndrome, c)
+        result[i] = value.to_bytes(chunk, 'little')
+    return result
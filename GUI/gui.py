@@ -4,6 +4,7 @@ import functools
 import os
 import queue
 import sys
+import time
 from multiprocessing import Process, Queue, freeze_support
 
 from PyQt5.QtCore import Qt, QSettings, QTimer
@@ -14,18 +15,21 @@ from PyQt5.QtWidgets import QWidget, QTableWidgetItem, QAbstractItemView, QHeade
 
 import chat_client
 import def_widget
+import manifest
 import server
 import trans_client
 
+QUEUE_BUDGET = 0.02  # 每次读取消息队列的时间上限(秒)，读不完的留到下一次
+PROG_INTERVAL = 40  # 进度更新间隔(毫秒)
+
 
 class FileStatus:
     """基本文件信息定义类。"""
 
-    def __init__(self, path):
+    def __init__(self, path, name=None):
         self.path = path
-        self.name = os.path.split(self.path)[1]
+        self.name = name or os.path.split(self.path)[1]  # 目录树中的文件为含目录的相对路径
         self._size = os.path.getsize(self.path)
-        self._all = self._size // 65000 + 1
         self._status = ['pending', '等待传输']
 
         picname = self._status[0] + '.png'
@@ -35,7 +39,7 @@ class FileStatus:
 
         self.prog = QProgressBar()
         self.prog.setTextVisible(False)
-        self.prog.setRange(0, self._all)
+        self.prog.setRange(0, 1)  # 分块总数由传输进程按实际分块大小回报
 
         self.label = QLabel(self.name)
         self.label.setToolTip(self.name)
@@ -65,6 +69,7 @@ class ClientWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.files = []  # 发送端待发送文件列表
+        self.dirs = []  # 选中的文件夹展开的各级目录：[(路径, 相对路径), ...]，随清单发送以保留空目录
         self.del_list = []  # 发送端待删除文件列表
         self.received_files = 0  # 接收端已接受文件数
         self.succeed_files = 0  # 接收端成功接受文件数
@@ -104,15 +109,18 @@ class ClientWindow(QMainWindow):
         menu_bar = self.menuBar()
         file_menu = menu_bar.addMenu('文件(&F)')
         self.act_choose = QAction('选择文件(&C)', self)
+        self.act_choose_dir = QAction('选择文件夹(&D)', self)
         self.act_send = QAction('发送(&S)', self)
         self.act_stop_send = QAction('中止传输(&E)', self)
         self.act_exit = QAction('退出(&Q)', self)
         file_menu.addAction(self.act_choose)
+        file_menu.addAction(self.act_choose_dir)
         file_menu.addAction(self.act_send)
         file_menu.addAction(self.act_stop_send)
         file_menu.addSeparator()
         file_menu.addAction(self.act_exit)
         self.act_choose.triggered.connect(self.file_dialog)
+        self.act_choose_dir.triggered.connect(self.dir_dialog)
         self.act_send.setDisabled(True)
         self.act_send.triggered.connect(self.file_checker)
         self.act_stop_send.setDisabled(True)
@@ -210,9 +218,10 @@ class ClientWindow(QMainWindow):
             setting_incoming_ip = self.settings.value('incoming_ip', '0.0.0.0')
             setting_bind_port = int(self.settings.value('bind_port', 54321))
             setting_receive_dir = self.settings.value('receive_dir', os.path.abspath('.'))
+            setting_workers = int(self.settings.value('workers', 1))
             self.settings.endGroup()
             self.server_starter = Process(target=server.starter, name='ServerStarter', args=(
-                setting_incoming_ip, setting_bind_port, setting_receive_dir, self.server_que))
+                setting_incoming_ip, setting_bind_port, setting_receive_dir, self.server_que, setting_workers))
             self.server_starter.start()
             self.server_timer = QTimer()  # 服务端消息读取循环
             self.server_timer.timeout.connect(self.server_status)
@@ -310,6 +319,7 @@ class ClientWindow(QMainWindow):
         self.Bfile_sender.clicked.disconnect(self.file_checker)
         self.Bfile_sender.clicked.connect(self.abort_trans)
         self.act_choose.setDisabled(True)
+        self.act_choose_dir.setDisabled(True)
         self.act_send.setDisabled(True)
         self.act_stop_send.setDisabled(False)
         self.Bselector.setDisabled(True)
@@ -322,6 +332,7 @@ class ClientWindow(QMainWindow):
         self.Bfile_sender.clicked.disconnect(self.abort_trans)
         self.Bfile_sender.clicked.connect(self.file_checker)
         self.act_choose.setDisabled(False)
+        self.act_choose_dir.setDisabled(False)
         self.act_stop_send.setDisabled(True)
         self.Bselector.setDisabled(False)
         for inst in self.files:  # 启用删除按钮
@@ -377,6 +388,16 @@ class ClientWindow(QMainWindow):
         self.ui_sending()
         self.settings.beginGroup('ClientSetting')
         setting_file_at_same_time = int(self.settings.value('file_at_same_time', 2))
+        setting_window = int(self.settings.value('window', 0))
+        setting_congestion = self.settings.value('congestion', 'aimd')
+        setting_chunk = int(self.settings.value('chunk', 0))
+        setting_verify = self.settings.value('verify', 'md5')
+        setting_bundle = int(self.settings.value('bundle', True))
+        setting_delta = int(self.settings.value('delta', False))
+        setting_dedup = int(self.settings.value('dedup', False))
+        setting_compress = int(self.settings.value('compress', 0))
+        setting_fec = int(self.settings.value('fec', 0))
+        setting_stripes = int(self.settings.value('stripes', 1))
         setting_host = self.settings.value('host', '127.0.0.1')
         setting_port = int(self.settings.value('server_port', 12345))
         self.settings.endGroup()
@@ -385,10 +406,12 @@ class ClientWindow(QMainWindow):
             inst.prog.setValue(0)
             index = self.find_index_by_name(inst.name)
             self.file_table.item(index, 4).setText('传输中')
-        path_list = [inst.path for inst in self.files]
+        path_list = self.dirs + [(inst.path, inst.name) for inst in self.files]
         try:
             self.file_sender = Process(target=trans_client.starter, name='FileSender', args=(
-                setting_host, setting_port, path_list, setting_file_at_same_time, self.client_que))
+                setting_host, setting_port, path_list, setting_file_at_same_time, self.client_que, setting_window,
+                setting_congestion, setting_chunk, setting_verify, bool(setting_bundle), bool(setting_delta),
+                bool(setting_dedup), setting_compress, setting_fec, setting_stripes))
             self.file_sender.start()
             self.Lclient_status.setText(
                 '''传输中：<font color=green>0<font color=black>/<font color=red>0<font color=black>/{0} 
@@ -398,14 +421,18 @@ class ClientWindow(QMainWindow):
             self.Lclient_status.setText(repr(e))
         self.prog_timer = QTimer()  # 启动进度条更新监控
         self.prog_timer.timeout.connect(self.update_prog)
-        self.prog_timer.start(5)
+        self.prog_timer.start(PROG_INTERVAL)
 
     """后台监控函数"""
 
     def server_status(self):
-        """启动时循环读取服务端状态及更新聊天信息。"""
-        try:
-            message = self.server_que.get(block=False)
+        """启动时循环读取服务端状态及更新聊天信息，每次读完队列中的消息(不超过QUEUE_BUDGET)。"""
+        deadline = time.monotonic() + QUEUE_BUDGET
+        while time.monotonic() < deadline:
+            try:
+                message = self.server_que.get(block=False)
+            except queue.Empty:
+                break
             if message['type'] == 'server_info':
                 if message['message'] == 'error':
                     self.Lserver_status.setText(message['detail'])
@@ -430,6 +457,9 @@ class ClientWindow(QMainWindow):
                         '''新文件传入 {0}=<font color=green>{1}<font color=black>+<font color=red>{2}<font color=black> 
                         (Tol=<font color=green>Comp<font color=black>+<font color=red>Err<font color=black>)'''.format(
                             self.received_files, self.succeed_files, self.failed_files))
+                elif message['message'] == 'repairing':
+                    self.Lserver_status.setText('{0}校验失败，正在重新接收{1}个损坏分块'.format(
+                        message['name'], message['parts']))
                 elif message['message'] == 'aborted':  # 中断数统计
                     self.Lserver_status.setText(
                         '''传输中断 {0}=<font color=green>{1}<font color=black>+<font color=red>{2}<font color=black> 
@@ -450,13 +480,24 @@ class ClientWindow(QMainWindow):
                     self.Emessage_area.append(
                         '{0}:{1}：\n    {2}'.format(message['from'][0], message['from'][1], message['message']))
                     self.Lserver_status.setText('收到来自{0}:{1}的聊天消息'.format(message['from'][0], message['from'][1]))
-        except queue.Empty:
-            pass
 
     def update_prog(self):
-        """传输过程管理及进度条更新函数。"""
-        try:
-            message = self.client_que.get(block=False)
+        """
+        传输过程管理及进度条更新函数。
+        每次读完队列中的消息(不超过QUEUE_BUDGET)，进度消息每个文件只保留最新的一条，最后一并更新进度条
+        """
+        progs = {}  # 各文件最新的进度消息
+        deadline = time.monotonic() + QUEUE_BUDGET
+        while self.prog_timer.isActive() and time.monotonic() < deadline:
+            try:
+                message = self.client_que.get(block=False)
+            except queue.Empty:
+                break
+            if message['type'] == 'prog':
+                progs[message['name']] = message
+                continue
+            self.show_progs(progs)  # 先显示此前的进度，以免覆盖结果消息的显示
+            progs.clear()
             inst = self.find_instance_by_name(message['name'])  # 考虑到简明视图的性能，不全局计算index
             if message['type'] == 'info':
                 if message['message'] == 'MD5_passed':
@@ -470,6 +511,18 @@ class ClientWindow(QMainWindow):
                     index = self.find_index_by_name(message['name'])
                     self.file_table.item(index, 4).setText('传输错误')
                     self.file_table.item(index, 2).setText('100 %')
+                elif message['message'] == 'rejected':  # 接收端协议版本不兼容
+                    inst.status = 'error'
+                    index = self.find_index_by_name(message['name'])
+                    self.file_table.item(index, 4).setText('版本不兼容')
+                elif message['message'] == 'timeout':  # 长时间收不到接收端的任何回复
+                    inst.status = 'error'
+                    index = self.find_index_by_name(message['name'])
+                    self.file_table.item(index, 4).setText('连接超时')
+                elif message['message'] == 'error':  # 源文件无法读取
+                    inst.status = 'error'
+                    index = self.find_index_by_name(message['name'])
+                    self.file_table.item(index, 4).setText('读取失败')
                 elif message['message'] == 'aborted':
                     for inst in self.find_instance_by_status('uploading'):
                         inst.status = 'error'
@@ -534,14 +587,23 @@ class ClientWindow(QMainWindow):
                         (<font color=green>Comp<font color=black>/<font color=red>Err<font color=black>/Up)'''.format(
                             len(self.find_instance_by_status('complete')), len(self.find_instance_by_status('error')),
                             len(self.find_instance_by_status('uploading'))))
-            elif message['type'] == 'prog':
-                inst.prog.setValue(message['part'] + 1)
-                if self.setting_detail_view:  # 详细视图：更新进度百分比
-                    index = self.find_index_by_name(message['name'])
-                    file_prog = message['part'] / inst.prog.maximum() * 100
-                    self.file_table.item(index, 2).setText('{0:.2f} %'.format(file_prog))
-        except queue.Empty:
-            pass
+        self.show_progs(progs)
+
+    def show_progs(self, progs):
+        """按各文件最新的进度消息更新进度条。"""
+        for message in progs.values():
+            inst = self.find_instance_by_name(message['name'])
+            if inst.prog.maximum() != message['all']:
+                inst.prog.setMaximum(message['all'])
+            inst.prog.setValue(message['part'] + 1)
+            srtt, rttvar, rto = message['rtt']  # 在按钮提示中显示往返时延估计
+            if srtt is not None:
+                inst.button.setToolTip('{0}\nSRTT: {1} ms  RTTVAR: {2} ms  RTO: {3} ms'.format(
+                    inst.status[1], srtt, rttvar, rto))
+            if self.setting_detail_view:  # 详细视图：更新进度百分比
+                index = self.find_index_by_name(message['name'])
+                file_prog = message['part'] / inst.prog.maximum() * 100
+                self.file_table.item(index, 2).setText('{0:.2f} %'.format(file_prog))
 
     """绑定事件函数"""
 
@@ -551,6 +613,7 @@ class ClientWindow(QMainWindow):
         self.file_table.removeRow(index)
         self.files.remove(inst)
         if not self.files:
+            self.dirs = []
             self.file_table.hide()
             self.Lfile_empty.show()
             self.act_send.setDisabled(True)
@@ -682,19 +745,43 @@ class ClientWindow(QMainWindow):
             old_name = {inst.name for inst in self.files}
             same_list = {path for path in new_list if os.path.split(path)[1] in old_name}
             add_list = new_list - old_list - same_list  # 用集合set求纯新增文件路径列表（剔除重名项）
-            add_files = [FileStatus(path) for path in add_list]
-            self.Lfile_empty.hide()
-            if not self.setting_detail_view:
-                self.simple_viewer(add_files)
-            else:
-                self.detail_viewer(add_files)
-            self.Bfile_sender.setDisabled(False)
-            self.act_send.setDisabled(False)
+            self.file_adder([FileStatus(path) for path in add_list])
             self.settings.beginGroup('Misc')
             self.settings.setValue('path_history', os.path.split(fname[0][-1])[0])
             self.settings.endGroup()
         self.settings.sync()
 
+    def dir_dialog(self):
+        """文件夹选择对话框，将目录树展开为文件实例，文件名为含目录的相对路径。"""
+        self.settings.beginGroup('Misc')
+        setting_path_history = self.settings.value('path_history', '.')
+        self.settings.endGroup()
+        dname = QFileDialog.getExistingDirectory(self, '请选择文件夹', setting_path_history)
+        if dname:
+            files, entries = manifest.walker([dname])
+            root = os.path.dirname(os.path.abspath(dname))
+            picked = [(os.path.join(root, *name.split('/')), name) for name, size, mode in entries
+                      if size == manifest.DIRECTORY]
+            self.dirs += [item for item in picked if item not in self.dirs]
+            old_name = {inst.name for inst in self.files}
+            add_files = [FileStatus(path, name) for path, name in files if name not in old_name]
+            if add_files:
+                self.file_adder(add_files)
+            self.settings.beginGroup('Misc')
+            self.settings.setValue('path_history', os.path.split(dname)[0])
+            self.settings.endGroup()
+        self.settings.sync()
+
+    def file_adder(self, add_files):
+        """将新文件实例加入列表视图。"""
+        self.Lfile_empty.hide()
+        if not self.setting_detail_view:
+            self.simple_viewer(add_files)
+        else:
+            self.detail_viewer(add_files)
+        self.Bfile_sender.setDisabled(False)
+        self.act_send.setDisabled(False)
+
     def client_setting_dialog(self):
         self.client_setting = def_widget.ClientSettingDialog(self)
         self.client_setting.setAttribute(Qt.WA_DeleteOnClose)
@@ -0,0 +1,112 @@
+# coding:utf-8
+"""
+断点续传日志。
+接收端为每个传输在保存目录下维护一个旁路日志文件，记录文件信息及已写入分块的位图，
+各分块的校验和由写入线程按分块序号写入另一个旁路文件，不占用内存，日志落盘时也不必重写；
+传输中断后同一文件(名称、大小、源文件指纹及分块大小均相同)重新发送时据此跳过已收到的分块，
+整个文件校验失败时据此找出损坏的分块。
+"""
+import json
+import os
+import struct
+import threading
+
+SUFFIX = '.ftjournal'
+CRC_SUFFIX = '.ftcrc'
+JOURNAL_INTERVAL = 1.0  # 日志落盘间隔(秒)
+CRC = struct.Struct('<I')  # 校验和旁路文件中每个分块的校验和
+
+
+def path_of(save_dir, name):
+    """返回名为name的传输的日志路径，name为本地相对路径时日志位于文件所在的子目录。"""
+    head, tail = os.path.split(name)
+    return os.path.join(save_dir, head, '.' + tail + SUFFIX)
+
+
+class Journal:
+    """
+    单个传输的已接收分块日志类，写入线程写入校验和，摘要线程定时落盘。
+    接收期间位图与会话共用，由事件循环标记已接收的分块，落盘时去掉尚未写完的分块
+    """
+
+    def __init__(self, path, info, bitmap=None):
+        self.path = path
+        self.crc_path = path[:-len(SUFFIX)] + CRC_SUFFIX
+        self.info = info  # 文件信息：{name, file, size, key, chunk, all, segment}，file为保存的文件名
+        self.bitmap = bitmap or bytearray((info['all'] + 7) // 8)
+        self.crc_fd = None  # 校验和旁路文件，接收期间保持打开
+        self.saving = threading.Lock()  # 落盘与删除互斥，删除后不再落盘
+        self.removed = False
+        self.dirty = False  # 有未落盘的标记，写入线程写完分块时置位
+
+    def unmark(self, parts):
+        """清除分块的标记，在事件循环中调用。"""
+        for part in parts:
+            self.bitmap[part >> 3] &= ~(1 << (part & 7))
+        self.dirty = True
+
+    def open(self, new=False):
+        """打开校验和旁路文件，返回供写入线程按分块序号写入的文件描述符，new为真时清空。"""
+        flags = os.O_RDWR | os.O_CREAT | (os.O_TRUNC if new else 0) | getattr(os, 'O_BINARY', 0)
+        self.crc_fd = os.open(self.crc_path, flags, 0o666)
+        os.ftruncate(self.crc_fd, CRC.size * self.info['all'])
+        return self.crc_fd
+
+    def close(self):
+        if self.crc_fd is not None:
+            os.close(self.crc_fd)
+            self.crc_fd = None
+
+    def crcs_of(self, parts):
+        """按parts的顺序读出各分块的校验和。"""
+        with open(self.crc_path, 'rb') as f:
+            for part in parts:
+                f.seek(part * CRC.size)
+                yield CRC.unpack(f.read(CRC.size))[0]
+
+    def matches(self, info):
+        """判断日志是否属于同一文件的同一分块方式。"""
+        return all(self.info.get(key) == info.get(key) for key in ('size', 'key', 'chunk', 'all', 'segment'))
+
+    def save(self, pending=()):
+        """
+        有新标记时将日志写入临时文件再替换，保证日志文件始终完整。
+        pending为尚未写完或写入失败的分块，其标记已由事件循环置位，不记入日志
+        """
+        if not self.dirty:
+            return
+        self.dirty = False
+        bitmap = bytearray(self.bitmap)  # 须先于pending复制：事件循环先登记写入再置位
+        for part in list(pending):
+            bitmap[part >> 3] &= ~(1 << (part & 7))
+        with self.saving:
+            if self.removed:
+                return
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(json.dumps(self.info).encode() + b'\n' + bitmap)
+            os.replace(self.path + '.tmp', self.path)
+
+    def remove(self):
+        with self.saving:
+            self.removed = True
+            for path in (self.path, self.crc_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def load(save_dir, name):
+    """读取名为name的传输的日志，不存在、已损坏或对应的文件已不存在时返回None。"""
+    path = path_of(save_dir, name)
+    try:
+        with open(path, 'rb') as f:
+            head, body = f.read().split(b'\n', 1)
+        info = json.loads(head)
+        record = Journal(path, info, bytearray(body))
+        if len(body) != (info['all'] + 7) // 8 or os.path.getsize(record.crc_path) != CRC.size * info['all'] \
+                or not os.path.isfile(os.path.join(save_dir, info['file'])):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return record
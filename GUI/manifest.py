@@ -0,0 +1,91 @@
+# coding:utf-8
+"""
+目录树清单。
+发送端展开选中的目录，把各目录及文件的相对路径、长度及权限写成清单，作为第一个传输发送，
+接收端校验通过后按清单重建目录树(含空目录)；各文件以相对路径为名与普通文件一样并行传输，写入对应的子目录。
+相对路径以/分隔，接收端去掉其中的空、.及..部分，只写入保存目录之内
+"""
+import hashlib
+import io
+import json
+import os
+import stat
+
+SUFFIX = '.ftmanifest'
+DIRECTORY = -1  # 清单中目录的长度
+
+
+def mode_of(path):
+    """返回文件或目录的权限位。"""
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def walker(paths):
+    """
+    展开路径列表，返回文件列表[(路径, 相对路径), ...]及清单条目[[相对路径, 长度, 权限], ...]。
+    目录以其自身名称为根展开；(路径, 相对路径)形式的项按给出的相对路径发送，路径为目录时只记入清单而不展开，
+    以便只发送列表中的文件而保留空目录；各项的上级目录同样记入清单，没有目录时清单条目为空
+    """
+    files = []
+    dirs = {}  # {相对路径: 路径}
+    for item in paths:
+        if isinstance(item, (tuple, list)):
+            if os.path.isdir(item[0]):
+                dirs[item[1]] = item[0]
+            else:
+                files.append(tuple(item))
+        elif os.path.isdir(item):
+            root = os.path.dirname(os.path.abspath(item))
+            for top, subdirs, names in os.walk(item):
+                subdirs.sort()
+                rel = os.path.relpath(os.path.abspath(top), root).replace(os.sep, '/')
+                dirs[rel] = top
+                files += [(os.path.join(top, name), rel + '/' + name) for name in sorted(names)]
+        else:
+            files.append((item, os.path.basename(item)))
+    for path, name in files + [(path, name) for name, path in dirs.items()]:
+        while '/' in name:
+            name = name.rsplit('/', 1)[0]
+            path = os.path.dirname(path)
+            dirs.setdefault(name, path)
+    entries = []
+    items = [(name, path, True) for name, path in sorted(dirs.items())]
+    items += [(name, path, False) for path, name in files if '/' in name]
+    for name, path, is_dir in items:
+        try:
+            entries.append([name, DIRECTORY if is_dir else os.path.getsize(path), mode_of(path)])
+        except OSError:  # 选定后被删除或无法访问的项不记入清单，其中的文件由各自的传输报告错误
+            continue
+    return files, entries
+
+
+class Manifest(io.BytesIO):
+    """清单流类，内容为清单条目的JSON。"""
+
+    def __init__(self, entries):
+        data = json.dumps(entries).encode()
+        super().__init__(data)
+        self.entries = entries
+        self.size = len(data)
+        self.key = hashlib.md5(data).hexdigest()
+        self.name = '.' + self.key + SUFFIX
+
+
+def local_name(name):
+    """
+    将发送端的相对路径转为本地相对路径，防止写到保存目录之外：去掉空、.及..部分(含开头的/及\\\\)，
+    以及含:的部分，Windows上C:之类的盘符会使os.path.join丢弃保存目录，a:b则是备用数据流
+    """
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..') and ':' not in part]
+    return os.path.join(*parts) if parts else '_'
+
+
+def dir_maker(path, save_dir):
+    """按清单在保存目录下建立各目录并设置权限，保留所有者的读写权限以便写入其中的文件。"""
+    with open(path, 'rb') as f:
+        entries = json.loads(f.read())
+    for name, size, mode in entries:
+        if size == DIRECTORY:
+            target = os.path.join(save_dir, local_name(name))
+            os.makedirs(target, exist_ok=True)
+            os.chmod(target, mode | stat.S_IRWXU)
@@ -0,0 +1,106 @@
+# coding:utf-8
+"""
+数据报格式。
+每个数据报以定长二进制头开始，其后为负载：
+数据分块的负载为文件数据，控制消息的负载为json打包的消息字典；头部带有负载的CRC32校验和。
+头部前3字节(标识及版本号)在各版本间保持不变，用于识别并拒绝不兼容的对端。
+"""
+import collections
+import json
+import struct
+import zlib
+
+MAGIC = b'FT'
+VERSION = 3  # 2：文件摘要改由尾包消息发送，不再附在末块负载之前；3：头部加入负载校验和
+
+DATA = 1  # 数据分块
+CONTROL = 2  # 控制消息
+PROBE = 3  # 路径MTU探测包，负载为填充数据
+PARITY = 4  # 前向纠错的校验块：分块序号为所在组的首块序号，标志为校验序号及组内分块数
+
+FLAG_ACK_NOW = 0x01  # 要求接收端立即确认
+FLAG_COMPRESSED = 0x02  # 数据分块的负载已按握手时协商的算法压缩
+
+# 标识、版本、类型、标志、(填充)、传输编号、分块序号、负载长度、发送时间戳、回显时间戳、回显前的停留时间
+BODY = struct.Struct('!2sBBBxIIIddf')
+# 头部以校验和结尾：先对负载、再接着对其前的头部计算的CRC32
+HEADER = struct.Struct(BODY.format + 'I')
+LENGTH_AT = struct.calcsize('!2sBBBxII')  # 负载长度字段的偏移
+
+Header = collections.namedtuple('Header', 'version type flags tid part length ts echo hold crc')
+
+
+def version_of(data):
+    """返回数据报的协议版本，不是本协议的数据报(如旧版本的json消息)返回None。"""
+    if len(data) < HEADER.size or data[:2] != MAGIC:
+        return None
+    return data[2]
+
+
+def pack(kind, flags, tid, part, ts, echo, hold, payload):
+    """打包头部及负载并附上校验和。"""
+    body = BODY.pack(MAGIC, VERSION, kind, flags, tid, part, len(payload), ts, echo, hold)
+    return body + zlib.crc32(body, zlib.crc32(payload)).to_bytes(4, 'big') + payload
+
+
+def pack_data(tid, part, flags, ts, echo, hold, payload):
+    """打包数据分块，echo为0表示没有可回显的时间戳。"""
+    return pack(DATA, flags, tid, part, ts, echo, hold, payload)
+
+
+def pack_parity(tid, start, count, index, ts, echo, hold, payload):
+    """打包校验块，start及count为所在组的首块序号及分块数(1~32)，index为校验序号(0~7)。"""
+    return pack(PARITY, index << 5 | count - 1, tid, start, ts, echo, hold, payload)
+
+
+def parity_fields(header):
+    """返回校验块的(校验序号, 组内分块数)。"""
+    return header.flags >> 5, (header.flags & 0x1f) + 1
+
+
+def pack_control(message, tid, ts, echo, hold):
+    """打包控制消息。"""
+    return pack(CONTROL, 0, tid, 0, ts, echo, hold, json.dumps(message).encode())
+
+
+def pack_probe(size):
+    """打包总长为size字节的路径MTU探测包。"""
+    return pack(PROBE, 0, 0, size, 0.0, 0.0, 0.0, bytes(size - HEADER.size))
+
+
+def unpack(data):
+    """
+    解析数据报，返回(头部, 负载)。
+    负载为原数据报的memoryview切片，不复制数据；格式不符时抛出ValueError
+    """
+    if version_of(data) != VERSION:
+        raise ValueError('incompatible datagram')
+    header = Header(*HEADER.unpack_from(data)[1:])
+    if HEADER.size + header.length > len(data):
+        raise ValueError('truncated datagram')
+    return header, memoryview(data)[HEADER.size:HEADER.size + header.length]
+
+
+def payload_crc(data):
+    """
+    校验数据报的头部及负载，一致时返回负载的CRC32，损坏时返回None。
+    版本号按本版本计算，版本号损坏的本版本数据报因此仍能通过校验，供拒绝不兼容对端前排除
+    """
+    view = memoryview(data)
+    length = int.from_bytes(view[LENGTH_AT:LENGTH_AT + 4], 'big')
+    if HEADER.size + length > len(data):
+        return None
+    crc = zlib.crc32(view[HEADER.size:HEADER.size + length])
+    if zlib.crc32(MAGIC + bytes([VERSION]) + view[3:BODY.size], crc) != int.from_bytes(view[BODY.size:HEADER.size], 'big'):
+        return None
+    return crc
+
+
+def intact(data):
+    """校验数据报是否完整。"""
+    return payload_crc(data) is not None
+
+
+def message_of(payload):
+    """将控制消息的负载还原为消息字典。"""
+    return json.loads(bytes(payload))
@@ -0,0 +1,54 @@
+# coding:utf-8
+"""
+往返时延估计。
+按RFC 6298计算平滑往返时延及其偏差，并由此得出带指数退避的重发超时时间。
+样本扣除了对端的确认合并延时，重发超时须再加上该延时的上限，否则时延稳定时被合并的确认会触发虚假重发。
+"""
+
+RTO_INIT = 0.3  # 尚无样本时的重发超时(秒)
+RTO_MIN = 0.05  # 重发超时下限(秒)，需大于服务端的确认合并延时
+RTO_MAX = 10  # 重发超时上限(秒)
+ACK_DELAY_MAX = 0.025  # 对端确认合并延时的上限(秒)，不小于服务端的ACK_DELAY
+
+
+class RttEstimator:
+    """单个会话的往返时延估计类。"""
+
+    def __init__(self):
+        self.srtt = None  # 平滑往返时延
+        self.rttvar = None  # 往返时延偏差
+        self.backoff = 1  # 退避倍数
+        self.min_rtt = None  # 最小往返时延，作为无排队时的基准
+
+    @property
+    def rto(self):
+        """当前的重发超时时间(秒)。"""
+        if self.srtt is None:
+            rto = RTO_INIT
+        else:
+            rto = max(self.srtt + 4 * self.rttvar + ACK_DELAY_MAX, RTO_MIN)
+        return min(rto * self.backoff, RTO_MAX)
+
+    def sample(self, rtt):
+        """加入一个往返时延样本(秒)，新样本同时清除退避。"""
+        rtt = max(rtt, 0.0)
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.backoff = 1
+
+    def timeout(self):
+        """发生超时重发时将超时时间加倍。"""
+        if self.rto < RTO_MAX:
+            self.backoff *= 2
+
+    def status(self):
+        """返回以毫秒计的(srtt, rttvar, rto)，供界面显示。"""
+        if self.srtt is None:
+            return None, None, round(self.rto * 1000, 1)
+        return round(self.srtt * 1000, 1), round(self.rttvar * 1000, 1), round(self.rto * 1000, 1)
@@ -2,13 +2,89 @@
 """
 UDP服务端，等待客户端的连接。
 有连接呼入时接收文件并保存。
+多进程接收时各进程以SO_REUSEPORT绑定同一端口，由内核按客户端地址将各传输分给不同进程，状态消息汇入同一队列；
+中断消息只到达其中一个进程，由其经控制队列转告其余进程
 """
 import asyncio
+import concurrent.futures
+import functools
 import hashlib
 import json
+import multiprocessing
 import os
-import random
+import shutil
+import signal
+import socket
+import sys
 import threading
+import zlib
+
+import bundle
+import compress
+import contents
+import delta
+import fec
+import journal
+import manifest
+import packet
+import rtt
+import session
+import timerwheel
+import treehash
+
+ACK_EVERY = 8  # 每收到此数量的新分块立即回送一次确认
+ACK_DELAY = 0.02  # 确认消息的最长合并延时(秒)
+SACK_RANGES = 16  # 单个确认消息携带的最多区间数
+RESULT_RETRIES = 8  # 结果消息未收到terminated回包时的最多重发次数
+WRITERS = 4  # 写入线程池大小
+WRITE_BACKLOG = 256  # 等待写入的分块上限，超过时丢弃新分块由客户端重发
+RESUME_RANGES = 256  # 握手回包携带的已收分块区间数上限，其余分块由客户端重发
+REPAIR_ROUNDS = 2  # 整个文件校验失败时按分块校验和修复的最多轮数
+REPAIR_RANGES = 64  # 单轮修复的损坏区间数上限，超过时视为传输失败
+HASH_BACKLOG = 1024  # 等待按序摘要的乱序分块上限，超过时改为收齐后重读文件
+HASH_BLOCK = 1048576  # 重读文件计算摘要时的块大小(字节)
+
+
+if hasattr(os, 'pwrite'):
+    def positional_writer(fd, data, offset):
+        """在文件描述符的指定偏移处写入数据，不改变文件位置，可多线程并发调用。"""
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+else:  # 不支持pwrite的平台(Windows)以锁保护定位与写入
+    seek_lock = threading.Lock()
+
+    def positional_writer(fd, data, offset):
+        """在文件描述符的指定偏移处写入数据，可多线程并发调用。"""
+        with seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+
+
+def part_writer(fd, crc_fd, data, part, chunk, crc):
+    """在写入线程中写入分块，并按分块序号将其校验和写入校验和旁路文件。"""
+    positional_writer(fd, data, part * chunk)
+    positional_writer(crc_fd, journal.CRC.pack(crc), part * journal.CRC.size)
+
+
+def file_copier(source, target, mode):
+    """在旧文件读取线程中将已有的相同内容复制为新文件，并设置发送端的权限。"""
+    shutil.copyfile(source, target)
+    if mode is not None:
+        os.chmod(target, mode)
+
+
+def ranges_of(parts):
+    """将有序的分块序号合并为区间列表[start, end)。"""
+    ranges = []
+    for part in parts:
+        if ranges and ranges[-1][1] == part:
+            ranges[-1][1] = part + 1
+        else:
+            ranges.append([part, part + 1])
+    return ranges
 
 
 def display_file_length(file_size):
@@ -24,121 +100,711 @@ def display_file_length(file_size):
 
 
 class ServerProtocol(asyncio.DatagramProtocol):
-    """服务端主控类"""
+    """服务端主控类，peers为多进程接收时各进程的控制队列，worker为本进程的序号"""
 
-    def __init__(self, save_dir, que, loop):
+    def __init__(self, save_dir, que, loop, peers=None, worker=0):
         self.save_dir = save_dir
         self.que = que  # 服务端消息队列
         self.loop = loop
+        self.wheel = timerwheel.wheel_of(loop)  # 确认合并及结果消息重发的计时由全部会话共用
+        self.peers = peers or []
+        self.worker = worker
         self.aborted = False  # 中断标志位
         self.transport = None
 
-        self.time_counter = {}  # 计数器字典：{name1: {part1: counter, ...}, ...}
-        self.rename = {}  # 重命名字典：{true_name: fake_name}
+        self.sessions = {}  # 会话字典：{(客户端IP, transfer_id): Session}
+        self.names = {}  # 正在接收的文件名字典：{true_name: Session}，同名文件的并发传输只记录最早的一个
+        self.held = {}  # 等待接管同一文件的旧会话的握手：{(客户端IP, transfer_id): 首次收到的时间}
+        self.hasher = concurrent.futures.ThreadPoolExecutor(max_workers=1)  # 摘要线程，按提交顺序更新摘要
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=WRITERS)  # 写入线程池
+        # 旧文件读取线程：计算差异传输的签名页及复制已有内容，大文件的读取不阻塞摘要更新及日志落盘
+        self.reader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.backlog = threading.BoundedSemaphore(WRITE_BACKLOG)  # 等待写入的分块计数
+        self.contents = contents.ContentIndex(save_dir, not self.peers)  # 已校验通过的文件的内容索引
 
     def connection_made(self, transport):
         self.transport = transport
+        self.loop.call_later(journal.JOURNAL_INTERVAL, self.journal_saver)
+        self.loop.call_later(session.SWEEP_INTERVAL, self.session_sweeper)
 
     def datagram_received(self, data, addr):
-        info = json.loads(data.split(b'---+++data+++---')[0])
+        version = packet.version_of(data)
+        if version != packet.VERSION:
+            self.version_rejecter(data, version, addr)
+            return
+        try:
+            header, payload = packet.unpack(data)
+        except ValueError:  # 负载长度字段损坏
+            return
+        transfer = self.sessions.get((addr[0], header.tid))
+        crc = packet.payload_crc(data)
+        if crc is None:  # 校验和不符：数据分块要求立即重发，控制消息丢弃由对端超时重发
+            if header.type == packet.DATA and transfer and transfer.bitmap is not None:
+                self.message_sender({'type': 'message', 'data': 'nak', 'name': transfer.name, 'part': header.part},
+                                    addr, transfer)
+            return
+        if header.type == packet.PROBE:  # 路径MTU探测包：回报收到的尺寸
+            self.message_sender({'type': 'message', 'data': 'probe_ack', 'size': len(data)}, addr)
+            return
+        if transfer:
+            transfer.active = self.loop.time()
+            self.timestamp_checker(transfer, header)
+        if header.type == packet.DATA:
+            if transfer:
+                self.data_receiver(transfer, header, payload, crc, addr)
+            else:
+                self.reset_sender(header, addr)
+            return
+        if header.type == packet.PARITY:
+            if transfer:
+                self.parity_receiver(transfer, header, payload, addr)
+            return
+        info = packet.message_of(payload)
         if info['type'] == 'message':
             if info['data'] == 'established':
-                if info['name'] not in self.time_counter:
+                name = info['name']
+                if transfer:  # 握手回包丢失时客户端会重发握手消息
+                    if transfer.bitmap is not None:
+                        self.get_sender(transfer, addr)
+                    elif transfer.checking:  # 正在复制已有内容，回复以免客户端判定接收端已离开
+                        self.message_sender({'type': 'message', 'data': 'copying', 'name': name}, addr, transfer)
+                    return
+                if name not in self.names and self.content_copier(info, header, addr):
+                    return
+                previous = self.names.get(name)
+                key = (addr[0], header.tid)
+                now = self.loop.time()
+                resumable = previous and previous.key[0] == addr[0] and previous.journal is not None \
+                    and previous.journal.matches(info)
+                idle = resumable and previous.active <= now - session.takeover_idle(previous)
+                if resumable and not idle and self.held.setdefault(key, now) > now - session.TAKEOVER_IDLE:
+                    # 同一IP的同一文件的会话刚收到过数据报：可能是客户端崩溃后立即重发，暂不回复，
+                    # 待旧会话空闲到可以接管时由重发的握手消息续传；旧会话始终活跃时另开会话
+                    return
+                self.held.pop(key, None)
+                if idle:
+                    # 连接中断后客户端以新的传输编号重新发送同一文件，改为跟踪新的传输编号；
+                    # 其他客户端或仍在发送的同一文件另开会话，存为新文件
+                    self.sessions.pop(previous.key, None)
+                    transfer = previous
+                    transfer.key, transfer.tid = key, header.tid
+                    transfer.rtt = rtt.RttEstimator()
+                    transfer.active = self.loop.time()
+                    self.timestamp_checker(transfer, header)
+                else:  # 新传输，同名文件正在接收时另存为新文件
                     self.aborted = False  # 清除中断标志位
-                    self.rename[info['name']] = self.name_checker(info['name'])
-                    self.time_counter[info['name']] = {}  # 新建计时器记录
-                    self.que.put({'type': 'server_info', 'message': 'started', 'name': info['name']})
-                    self.message_sender({'type': 'message', 'data': 'get', 'name': info['name'], 'part': 0}, addr)
+                    transfer = session.Session(key, name, self.loop.time())
+                    self.timestamp_checker(transfer, header)
+                    self.journal_loader(transfer, info, bool(previous))
+                    transfer.start(info['all'], info['chunk'], transfer.journal.bitmap)
+                    # 续传时已写入的分块不在内存中，无法增量摘要
+                    if transfer.count:
+                        transfer.hashing = [None, 0, {}]
+                    elif info['segment']:
+                        transfer.hashing = [treehash.TreeHasher(info['segment']), 0, {}]
+                    else:
+                        transfer.hashing = [hashlib.md5(), 0, {}]
+                    self.names.setdefault(name, transfer)
+                    self.que.put({'type': 'server_info', 'message': 'started', 'name': name})
+                self.sessions[transfer.key] = transfer
+                transfer.codec = compress.chooser(info.get('codecs', []))
+                transfer.groups = [{}, {}, 0] if info.get('fec') else None
+                transfer.stripes = self.stripes_of(info)
+                self.get_sender(transfer, addr)
+            elif info['data'] == 'digest':  # 摘要尾包
+                if transfer and transfer.bitmap is not None:
+                    transfer.md5 = (info['md5'], info['leaves'])
+                    self.message_sender({'type': 'message', 'data': 'digest_ok', 'name': transfer.name}, addr, transfer)
+                    if transfer.count == transfer.total:
+                        self.receive_finisher(transfer, addr)
+                elif transfer and transfer.completed:  # digest_ok消息丢失
+                    self.message_sender({'type': 'message', 'data': 'digest_ok', 'name': transfer.name}, addr, transfer)
+                elif not transfer:
+                    self.reset_sender(header, addr)
+            elif info['data'] == 'signature':  # 差异传输：回送旧版本的签名页
+                self.signature_sender(info, header, addr)
             elif info['data'] == 'terminated':
+                if transfer and transfer.resending:
+                    transfer.timer.cancel()
+                    self.sessions.pop(transfer.key)
                 print('\nConnection terminated successfully.\n')
             elif info['data'] == 'abort':
                 if not self.aborted:  # 只接收一次中断消息
-                    self.aborted = True
-                    self.transport.sendto(json.dumps({'type': 'message', 'data': 'aborted'}).encode(), addr)
-                    for name in self.time_counter:  # 删除队列中的文件
-                        try:
-                            os.remove(os.path.join(self.save_dir, self.rename[name]))
-                        except OSError as e:
-                            self.que.put({'type': 'server_info', 'message': 'error', 'detail': repr(e)})
-                        self.que.put({'type': 'server_info', 'message': 'aborted'})
-                        index = len(self.time_counter[name]) - 1
-                        self.time_counter[name][index].cancel()
-                    self.time_counter = {}
-                    self.rename = {}
-        elif info['type'] == 'data':
-            data = data.split(b'---+++data+++---')[1]
-            if info['name'] in self.time_counter and info['part'] == len(self.time_counter[info['name']]) - 1:
-                self.time_counter[info['name']][info['part']].cancel()
-                self.time_counter[info['name']][info['part'] + 1] = None  # 插入新值，不接收重复块
-                wd = threading.Thread(target=self.write_data, args=(info, data, addr))
-                wd.start()
-                if len(self.time_counter[info['name']]) - 1 == info['all']:  # 末块行为
-                    wd.join()
-                    checker = threading.Thread(target=self.md5_checker, args=(info, addr))
-                    checker.start()
-                    msg = json.dumps({'type': 'message', 'data': 'complete', 'name': info['name']}).encode()
-                    self.transport.sendto(msg, addr)
-                    self.time_counter.pop(info['name'])
-                    self.rename.pop(info['name'])
+                    self.message_sender({'type': 'message', 'data': 'aborted'}, addr)
+                    self.aborter()
+                    for worker, peer in enumerate(self.peers):  # 转告其余接收进程
+                        if worker != self.worker:
+                            peer.put('abort')
         elif info['type'] == 'chat':
             self.que.put({'type': 'chat', 'status': 'received', 'message': info['message'], 'from': addr})
-            msg = json.dumps({'type': 'chat', 'message': info['message'], 'data': 'get'}).encode()
-            self.transport.sendto(msg, addr)
+            self.message_sender({'type': 'chat', 'message': info['message'], 'data': 'get'}, addr)
+
+    def get_sender(self, transfer, addr):
+        """回送握手回包(get消息)：已收分块区间、选定的压缩算法及是否接受前向纠错及分条发送。"""
+        self.message_sender({'type': 'message', 'data': 'get', 'name': transfer.name, 'part': 0,
+                             'ranges': self.resume_ranges(transfer), 'codec': transfer.codec,
+                             'fec': transfer.groups is not None, 'stripes': transfer.stripes}, addr, transfer)
+
+    def aborter(self):
+        """中断全部传输并清空全部会话，已中断时忽略。"""
+        if self.aborted:
+            return
+        self.aborted = True
+        for transfer in self.sessions.values():
+            self.session_closer(transfer)
+        self.sessions = {}
+        self.names = {}
+
+    def session_closer(self, transfer):
+        """结束会话的全部计时器，正在接收时保留已写入的部分文件并记入日志，同一文件重新发送时续传。"""
+        if transfer.timer:
+            transfer.timer.cancel()
+        if self.names.get(transfer.name) is transfer:
+            del self.names[transfer.name]
+        if transfer.bitmap is None:
+            return
+        concurrent.futures.wait(list(transfer.writing.values()))
+        os.close(transfer.fd)
+        transfer.journal.close()
+        self.hasher.submit(self.journal_writer, transfer.journal, transfer.writing)
+        transfer.bitmap = transfer.journal = None
+        self.que.put({'type': 'server_info', 'message': 'aborted'})
+
+    def session_sweeper(self):
+        """定时清除空闲超时的会话，摘要检查中的会话除外。"""
+        deadline = self.loop.time() - session.IDLE_TIMEOUT
+        for transfer in [transfer for transfer in self.sessions.values()
+                         if transfer.active < deadline and not transfer.checking]:
+            self.session_closer(transfer)
+            del self.sessions[transfer.key]
+        self.held = {key: first for key, first in self.held.items() if first > deadline}
+        self.loop.call_later(session.SWEEP_INTERVAL, self.session_sweeper)
+
+    def stripes_of(self, info):
+        """返回接受的分条数：多进程接收时同一传输的数据须经同一套接字到达，不接受分条发送。"""
+        return 1 if self.peers else info.get('stripes', 1)
+
+    def control_receiver(self):
+        """多进程接收时由线程等待其余进程转告的中断，交由事件循环处理。"""
+        while self.peers[self.worker].get() == 'abort':
+            self.loop.call_soon_threadsafe(self.aborter)
+
+    def data_receiver(self, transfer, header, payload, crc, addr):
+        """接收数据分块：任意顺序到达的分块均定位写入，并按合并策略回送选择确认。"""
+        if transfer.bitmap is not None:
+            if not transfer.has(header.part):  # 接收窗口内任意顺序到达的分块，不接收重复块
+                if header.flags & packet.FLAG_COMPRESSED:  # 解压后按原数据记录校验和、写入及摘要
+                    try:
+                        payload = compress.unpack(transfer.codec, payload, transfer.chunk)
+                    except ValueError:
+                        self.message_sender({'type': 'message', 'data': 'nak', 'name': transfer.name,
+                                             'part': header.part}, addr, transfer)
+                        return
+                    crc = zlib.crc32(payload)
+                if self.part_accepter(transfer, header.part, payload, crc, header.flags, addr) and transfer.groups:
+                    self.group_feeder(transfer, header.part, payload, addr)
+            else:  # 重复块说明确认消息可能丢失，立即确认
+                self.sack_sender(transfer, addr)
+        elif transfer.completed:  # complete消息丢失时客户端会重发在途分块
+            self.message_sender({'type': 'message', 'data': 'complete', 'name': transfer.name}, addr, transfer)
+
+    def part_accepter(self, transfer, part, payload, crc, flags, addr):
+        """写入新分块并更新确认状态，按合并策略回送选择确认，磁盘跟不上时丢弃并返回False。"""
+        if not self.backlog.acquire(blocking=False):  # 由客户端超时重发
+            return False
+        if transfer.resending:  # 修复消息已送达
+            transfer.timer.cancel()
+            transfer.timer, transfer.resending = None, False
+        future = self.writer.submit(part_writer, transfer.fd, transfer.journal.crc_fd, payload, part, transfer.chunk,
+                                    crc)
+        transfer.writing[part] = future  # 先登记再置位，日志落盘时不会记入未写完的分块
+        future.add_done_callback(functools.partial(self.write_checker, transfer.journal, transfer.writing, part))
+        transfer.add(part)
+        self.hash_feeder(transfer, part, payload)
+        transfer.unacked += 1
+        # 攒够分块、新出现空洞或客户端窗口已满时立即确认，否则合并到延时确认中
+        gap = part > transfer.cum and not transfer.has(part - 1)
+        if transfer.count == transfer.total and transfer.md5:
+            self.receive_finisher(transfer, addr)
+        elif transfer.unacked >= ACK_EVERY or gap or flags & packet.FLAG_ACK_NOW \
+                or transfer.count == transfer.total:  # 收齐但摘要尾包未到时也立即确认
+            self.sack_sender(transfer, addr)
+        elif not transfer.timer:
+            transfer.timer = self.wheel.call_later(ACK_DELAY, self.sack_sender, transfer, addr)
+        return True
+
+    def group_feeder(self, transfer, part, payload, addr):
+        """暂存新分块供恢复同组丢失的分块，有覆盖该分块的校验块时尝试恢复。"""
+        recent, parities = transfer.groups[:2]
+        recent[part] = payload
+        for start in [start for start in parities if start <= part < start + parities[start][0]]:
+            if transfer.groups:  # 恢复的分块可能使接收完成
+                self.group_decoder(transfer, start, addr)
+
+    def parity_receiver(self, transfer, header, payload, addr):
+        """暂存校验块并尝试恢复所在组丢失的分块，组内分块已收齐时忽略。"""
+        if not transfer.groups or transfer.bitmap is None:
+            return
+        index, count = packet.parity_fields(header)
+        start = header.part
+        if start + count > transfer.total or all(transfer.has(part) for part in range(start, start + count)):
+            return
+        parities = transfer.groups[1]
+        parities.setdefault(start, [count, {}])[1][index] = bytes(payload)
+        if len(parities) > fec.GROUPS_MAX:  # 校验块不足且分块未重发到达的组，放弃最早的
+            parities.pop(next(iter(parities)))
+        self.group_decoder(transfer, start, addr)
+
+    def group_decoder(self, transfer, start, addr):
+        """组内已收分块及校验块足够时恢复丢失的分块，按新到达的分块接收。"""
+        recent, parities = transfer.groups[:2]
+        count, blocks = parities[start]
+        known = {i: recent[start + i] for i in range(count) if start + i in recent}
+        if len(known) + len(blocks) < count:
+            return
+        parities.pop(start)
+        chunk = transfer.chunk
+        size = transfer.journal.info['size']
+        for i, data in sorted(fec.decode(known, blocks, count, chunk).items()):
+            part = start + i
+            if transfer.bitmap is not None and not transfer.has(part):
+                data = data[:min(chunk, size - part * chunk)]  # 去掉补零
+                if self.part_accepter(transfer, part, data, zlib.crc32(data), 0, addr) and transfer.groups:
+                    transfer.groups[0][part] = data
+                    transfer.groups[2] += 1
+
+    def receive_finisher(self, transfer, addr):
+        """分块收齐且摘要尾包已到达后的行为：清除接收记录并启动MD5检查线程。"""
+        if transfer.timer:
+            transfer.timer.cancel()
+            transfer.timer = None
+        path = os.path.join(self.save_dir, transfer.file)
+        md5 = transfer.hashing[0]
+        digest = self.hasher.submit(treehash.digest_of, md5) if md5 else None  # 排在全部摘要更新之后
+        transfer.checking = True
+        checker = threading.Thread(target=self.md5_checker, args=(
+            transfer, path, transfer.md5, transfer.fd, list(transfer.writing.values()), digest, transfer.journal, addr))
+        checker.start()
+        self.message_sender({'type': 'message', 'data': 'complete', 'name': transfer.name}, addr, transfer)
+        transfer.completed = True
+        if self.names.get(transfer.name) is transfer:
+            del self.names[transfer.name]
+        transfer.bitmap = transfer.fd = transfer.journal = transfer.md5 = transfer.hashing = transfer.groups = None
+
+    def version_rejecter(self, data, version, addr):
+        """拒绝协议版本不兼容的对端。"""
+        if version is not None and packet.intact(data):  # 只是版本号在途中损坏的本版本数据报
+            return
+        if version is None:  # 旧版本客户端的json消息
+            try:
+                info = json.loads(data)
+            except ValueError:
+                return
+            if isinstance(info, dict) and info.get('data') == 'established':
+                # 旧版本客户端只能识别MD5_failed，借此使其以传输错误结束
+                msg = {'type': 'message', 'data': 'MD5_failed', 'name': info['name']}
+                self.transport.sendto(json.dumps(msg).encode(), addr)
+            else:
+                return
+        else:
+            self.message_sender({'type': 'message', 'data': 'rejected', 'version': packet.VERSION}, addr)
+        self.que.put({'type': 'server_info', 'message': 'error',
+                      'detail': '已拒绝版本不兼容的发送端{0}:{1}'.format(addr[0], addr[1])})
 
     def connection_lost(self, exc):
+        self.writer.shutdown(wait=True)
+        self.hasher.shutdown(wait=True)
+        self.reader.shutdown(wait=True)
         print('Server terminated.')
 
-    def write_data(self, info, data, addr):
-        """写入本地数据并调用get消息回发函数。"""
-        with open(os.path.join(self.save_dir, self.rename[info['name']]), 'ab') as filedata:
-            filedata.write(data)
-        if not len(self.time_counter[info['name']]) - 1 == info['all']:  # 非末块则有回送操作
-            message = {'type': 'message', 'data': 'get', 'name': info['name'], 'part': info['part'] + 1}
-            self.message_sender(message, addr)
-
-    def message_sender(self, message, addr):
-        """自带随机秒重发机制的消息回发。"""
-        self.transport.sendto(json.dumps(message).encode(), addr)
-        self.time_counter[message['name']][message['part']] = \
-            self.loop.call_later(random.uniform(0.2, 0.4), self.message_sender, message, addr)
-
-    def md5_checker(self, info, addr):
-        """不带重发机制的MD5检查函数。"""
-        with open(os.path.join(self.save_dir, self.rename[info['name']]), 'rb') as filedata:
+    def write_checker(self, record, writing, part, future):
+        """
+        写入完成后释放写入额度，使日志记入该分块；
+        写入出错时报告给主进程，该分块留在未写完的分块中不记入日志，由校验失败后的修复重新接收
+        """
+        self.backlog.release()
+        if future.exception():
+            self.que.put({'type': 'server_info', 'message': 'error', 'detail': repr(future.exception())})
+        else:  # 先移出未写完的分块再标记，落盘线程清除标记时必已见到该分块写完
+            writing.pop(part, None)
+            record.dirty = True
+
+    def repair_starter(self, transfer, record, bad, expected, addr):
+        """重新打开已收齐的文件，要求客户端重发损坏的分块。"""
+        transfer.checking = False
+        if self.sessions.get(transfer.key) is not transfer or transfer.name in self.names:  # 会话已结束或已有同名的新传输
+            return
+        transfer.repairs += 1
+        record.unmark(bad)
+        transfer.journal = record
+        transfer.file = record.info['file']
+        transfer.fd = os.open(os.path.join(self.save_dir, transfer.file), os.O_RDWR | getattr(os, 'O_BINARY', 0),
+                              0o666)
+        record.open()
+        transfer.hashing = [None, 0, {}]
+        transfer.md5 = expected
+        self.names[transfer.name] = transfer
+        transfer.start(record.info['all'], record.info['chunk'], record.bitmap)
+        self.que.put({'type': 'server_info', 'message': 'repairing', 'name': transfer.name, 'parts': len(bad)})
+        self.result_sender(transfer, {'type': 'message', 'data': 'repair', 'name': transfer.name,
+                                    'round': transfer.repairs, 'ranges': ranges_of(bad)}, addr)
+
+    def hash_feeder(self, transfer, part, payload):
+        """按分块序号顺序将负载交给摘要线程，乱序到达的分块暂存至前面的分块到齐。"""
+        state = transfer.hashing
+        if state[0] is None:
+            return
+        state[2][part] = payload
+        while state[1] in state[2]:
+            self.hasher.submit(state[0].update, state[2].pop(state[1]))
+            state[1] += 1
+        if len(state[2]) > HASH_BACKLOG:  # 乱序过多时放弃增量摘要，避免暂存的负载占用过多内存
+            state[0] = None
+            state[2].clear()
+
+    def journal_loader(self, transfer, info, busy=False):
+        """
+        打开接收文件并准备续传日志。
+        有同一文件的日志时沿用原文件续传，否则删除过期的日志及部分文件后新建；
+        busy为真时同名文件正在接收，不动其日志，另存为新文件并以新文件名记录日志
+        """
+        name = info['name']
+        local = manifest.local_name(name)  # 目录树中的文件写入对应的子目录
+        record = None if busy else journal.load(self.save_dir, local)
+        if record and record.matches(info):
+            record.unmark([info['all'] - 1])  # 末块总是重新接收，客户端发出末块后才发送摘要尾包
+            flags = os.O_RDWR
+        else:
+            if record:
+                record.remove()
+                try:
+                    os.remove(os.path.join(self.save_dir, record.info['file']))
+                except OSError:
+                    pass
+            os.makedirs(os.path.join(self.save_dir, os.path.dirname(local)), exist_ok=True)
+            # 差异流写入旧版本旁的隐藏文件，重建后替换旧版本
+            target = self.name_checker(delta.temp_of(local) if info.get('delta') else local)
+            record = journal.Journal(journal.path_of(self.save_dir, target if busy else local), {
+                'name': name, 'file': target, 'size': info['size'], 'key': info['key'],
+                'chunk': info['chunk'], 'all': info['all'], 'segment': info['segment'],
+                'bundle': info.get('bundle', False), 'manifest': info.get('manifest', False),
+                'mode': info.get('mode'), 'delta': info.get('delta')})
+            flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC
+        transfer.journal = record
+        transfer.file = record.info['file']
+        # 权限同open()新建的文件，不设权限的文件(未收完或发送端未给出权限)不可执行
+        transfer.fd = os.open(os.path.join(self.save_dir, transfer.file), flags | getattr(os, 'O_BINARY', 0), 0o666)
+        record.open(bool(flags & os.O_TRUNC))
+
+    def journal_saver(self):
+        """定时将有新标记的续传日志交给摘要线程落盘，大文件的位图不阻塞事件循环。"""
+        for transfer in self.sessions.values():
+            if transfer.journal and transfer.journal.dirty:
+                self.hasher.submit(self.journal_writer, transfer.journal, transfer.writing)
+        self.loop.call_later(journal.JOURNAL_INTERVAL, self.journal_saver)
+
+    def journal_writer(self, record, pending):
+        """在摘要线程中将日志落盘，pending为会话中尚未写完的分块。"""
+        try:
+            record.save(pending)
+        except OSError as e:
+            self.que.put({'type': 'server_info', 'message': 'error', 'detail': repr(e)})
+
+    def resume_ranges(self, transfer):
+        """返回已收分块的区间列表供客户端跳过，不含末块。"""
+        ranges = [[0, transfer.cum]] if transfer.cum else []
+        ranges += transfer.ranges(RESUME_RANGES)
+        if ranges and ranges[-1][1] == transfer.total:
+            ranges[-1][1] -= 1
+            if ranges[-1][0] == ranges[-1][1]:
+                ranges.pop()
+        return ranges[:RESUME_RANGES]
+
+    def sack_sender(self, transfer, addr):
+        """发送选择确认消息：累计确认序号及其后已收分块的区间列表[start, end)。"""
+        if transfer.timer and not transfer.resending:  # 修复消息仍在重发时不取消其计时器
+            transfer.timer.cancel()
+            transfer.timer = None
+        transfer.unacked = 0
+        message = {'type': 'message', 'data': 'sack', 'name': transfer.name, 'cum': transfer.cum,
+                   'ranges': transfer.ranges(SACK_RANGES)}
+        if transfer.groups:  # 已由校验块恢复的分块数，供客户端估计丢包率
+            message['recovered'] = transfer.groups[2]
+            self.group_pruner(transfer)
+        self.message_sender(message, addr, transfer)
+
+    def group_pruner(self, transfer):
+        """丢弃不再需要的暂存分块及校验块：校验组不超过fec.GROUP块，累计确认点之前一组以外的分块已无用。"""
+        recent, parities = transfer.groups[:2]
+        floor = transfer.cum - fec.GROUP
+        for part in [part for part in recent if part < floor]:
+            del recent[part]
+        for start in [start for start in parities if start + parities[start][0] <= transfer.cum]:
+            del parities[start]
+
+    def timestamp_checker(self, transfer, header):
+        """记录客户端时间戳供回显，并由客户端的回显得到往返时延样本。"""
+        transfer.echo = (header.ts, self.loop.time())
+        if header.echo:
+            transfer.rtt.sample(self.loop.time() - header.echo - header.hold)
+
+    def message_sender(self, message, addr, transfer=None):
+        """
+        打包消息并加上传输编号、时间戳及回显后回发，不属于会话的消息传输编号为0。
+        丢失的回包由客户端的超时重发触发再次回送
+        """
+        ts = self.loop.time()
+        if transfer:
+            echo, arrival = transfer.echo
+            self.transport.sendto(packet.pack_control(message, transfer.tid, ts, echo, ts - arrival), addr)
+        else:
+            self.transport.sendto(packet.pack_control(message, 0, ts, 0.0, 0.0), addr)
+
+    def reset_sender(self, header, addr):
+        """会话已被清除(如空闲超时)时回复客户端的数据分块及摘要尾包，要求其以同一传输编号重新握手，按日志续传。"""
+        if header.tid:
+            self.transport.sendto(packet.pack_control({'type': 'message', 'data': 'reset'}, header.tid,
+                                                      self.loop.time(), header.ts, 0.0), addr)
+
+    def result_sender(self, transfer, message, addr, retries=RESULT_RETRIES):
+        """自带超时重发机制的结果消息发送，收到terminated回包或重发次数用尽后结束会话。"""
+        transfer.checking = False
+        if self.sessions.get(transfer.key) is not transfer:  # 会话已中断或已清除
+            return
+        self.message_sender(message, addr, transfer)
+        if retries:
+            transfer.timer = self.wheel.call_later(transfer.rtt.rto, self.result_timeout, transfer, message, addr,
+                                                   retries - 1)
+            transfer.resending = True
+        else:
+            transfer.timer, transfer.resending = None, False
+            del self.sessions[transfer.key]
+
+    def result_timeout(self, transfer, message, addr, retries):
+        """结果消息超时：退避重发超时后重发。"""
+        transfer.rtt.timeout()
+        self.result_sender(transfer, message, addr, retries)
+
+    def md5_checker(self, transfer, path, expected, fd, writers, digest, record, addr):
+        """
+        等待全部分块写入后关闭文件并进行摘要检查，结果消息交由事件循环发送。
+        digest为增量摘要的结果，为None时(续传或乱序过多)重读整个文件计算，树形哈希由线程池并行计算；
+        检查失败时按叶摘要及日志中的分块校验和找出损坏的分块，交由事件循环发起修复
+        """
+        concurrent.futures.wait(writers)
+        os.close(fd)
+        record.close()
+        name = transfer.name
+        md5_value, leaves_value = expected
+        segment = record.info['segment']
+        bundled = record.info.get('bundle')  # 打包流校验通过后拆出各文件
+        listed = record.info.get('manifest')  # 清单校验通过后建立目录树
+        patch = record.info.get('delta')  # 差异流校验通过后重建新文件
+        if digest:
+            md5_result, leaves = digest.result()
+        elif segment:
+            md5_result, leaves = treehash.tree_hash(path, segment)
+        else:
+            leaves = None
             md5 = hashlib.md5()
-            for line in filedata:
-                md5.update(line)
-        if md5.hexdigest() == info['md5']:
-            msg = json.dumps({'type': 'message', 'name': info['name'], 'data': 'MD5_passed'}).encode()
-            self.transport.sendto(msg, addr)
-            self.que.put({'type': 'server_info', 'message': 'MD5_passed', 'name': info['name']})
+            with open(path, 'rb') as filedata:
+                for block in iter(lambda: filedata.read(HASH_BLOCK), b''):
+                    md5.update(block)
+            md5_result = md5.hexdigest()
+        if md5_result == md5_value:
+            record.remove()
+            try:
+                if bundled:
+                    names = bundle.extract(path, self.save_dir,
+                                           lambda file_name: self.name_checker(manifest.local_name(file_name)))
+                elif listed:
+                    manifest.dir_maker(path, self.save_dir)
+                    names = []
+                else:
+                    names = [name]
+                    target = self.delta_applier(path, name, patch) if patch else path
+                    if record.info.get('mode') is not None:
+                        os.chmod(target, record.info['mode'])
+                    if patch:  # 差异流的摘要不是新文件的摘要，按新文件的MD5记入索引
+                        self.contents.add(patch['size'], 0, patch['md5'], target)
+                    else:
+                        self.contents.add(record.info['size'], segment, md5_value, target)
+            except (OSError, ValueError) as e:  # 打包流拆分、目录建立或差异重建失败按校验失败处理
+                self.que.put({'type': 'server_info', 'message': 'error', 'detail': repr(e)})
+            else:
+                if bundled or listed or patch:
+                    os.remove(path)
+                msg = {'type': 'message', 'name': name, 'data': 'MD5_passed'}
+                self.loop.call_soon_threadsafe(self.result_sender, transfer, msg, addr)
+                for file_name in names:
+                    self.que.put({'type': 'server_info', 'message': 'MD5_passed', 'name': file_name})
+                return
+        elif transfer.repairs < REPAIR_ROUNDS:
+            total = record.info['all']
+            if leaves and leaves_value and len(leaves) == len(leaves_value):  # 只检查叶摘要不符的分段
+                per = segment // record.info['chunk']
+                parts = [part for i, leaf in enumerate(leaves) if leaf != leaves_value[i]
+                         for part in range(i * per, min((i + 1) * per, total))]
+                bad = self.crc_checker(path, record, parts) or parts
+            else:
+                bad = self.crc_checker(path, record, range(total))
+            if bad and len(ranges_of(bad)) <= REPAIR_RANGES:
+                self.loop.call_soon_threadsafe(self.repair_starter, transfer, record, bad, expected, addr)
+                return
+        record.remove()
+        if bundled or listed or patch:  # 校验失败的打包流、清单及差异流无法使用，不保留
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        msg = {'type': 'message', 'name': name, 'data': 'MD5_failed'}
+        self.loop.call_soon_threadsafe(self.result_sender, transfer, msg, addr)
+        self.que.put({'type': 'server_info', 'message': 'MD5_failed', 'name': name})
+
+    def content_copier(self, info, header, addr):
+        """
+        内容索引中有与握手消息的内容摘要相同的文件时，在旧文件读取线程中将其复制为该文件，返回是否已处理。
+        复制得到的是独立的文件，修改其中一个不影响另一个；同名文件已是该内容时不再复制，直接回送校验通过
+        """
+        content = info.get('content')
+        source = content and self.contents.find(content['size'], content['segment'], content['md5'])
+        if not source:
+            return False
+        name = info['name']
+        local = manifest.local_name(name)
+        path = os.path.join(self.save_dir, local)
+        target = None
+        if not (os.path.exists(path) and os.path.samefile(source, path)):
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                target = os.path.join(self.save_dir, self.name_checker(local))
+                open(target, 'xb').close()  # 先建空文件占用文件名，复制期间同名的新传输另存为新文件
+            except OSError:
+                return False
+        transfer = session.Session((addr[0], header.tid), name, self.loop.time())
+        self.sessions[transfer.key] = transfer
+        self.timestamp_checker(transfer, header)
+        if target is None:
+            self.copy_checker(transfer, content, None, addr, None)
+            return True
+        transfer.checking = True  # 复制期间不作为空闲会话清除
+        future = self.reader.submit(file_copier, source, target, info.get('mode'))
+        future.add_done_callback(lambda f: self.loop.call_soon_threadsafe(
+            self.copy_checker, transfer, content, target, addr, f))
+        return True
+
+    def copy_checker(self, transfer, content, target, addr, future):
+        """
+        复制完成后回送校验通过；复制失败时删除副本及该内容的索引记录并清除会话，
+        客户端重发的握手消息照常开始传输
+        """
+        transfer.checking = False
+        if future and future.exception():
+            self.contents.discard(content['size'], content['segment'], content['md5'])
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+            if self.sessions.get(transfer.key) is transfer:
+                del self.sessions[transfer.key]
+            self.que.put({'type': 'server_info', 'message': 'error', 'detail': repr(future.exception())})
+            return
+        if self.sessions.get(transfer.key) is not transfer:  # 复制期间传输已中断
+            return
+        self.result_sender(transfer, {'type': 'message', 'name': transfer.name, 'data': 'MD5_passed'}, addr)
+        self.que.put({'type': 'server_info', 'message': 'MD5_passed', 'name': transfer.name})
+
+    def delta_applier(self, path, name, patch):
+        """由旧版本及差异流重建新文件，摘要相符时替换旧版本，返回文件路径。"""
+        basis = os.path.join(self.save_dir, manifest.local_name(name))
+        rebuilt = path + '.tmp'
+        try:
+            if delta.rebuild(path, basis, rebuilt, patch['block']) != patch['md5']:
+                raise ValueError('重建文件的MD5不符：{0}'.format(name))
+            os.replace(rebuilt, basis)
+        finally:
+            if os.path.exists(rebuilt):
+                os.remove(rebuilt)
+        return basis
+
+    def signature_sender(self, info, header, addr):
+        """
+        在旧文件读取线程中计算旧版本中请求的各签名页，由事件循环回送。
+        正在接收或未接收完整的同名文件不能作为旧版本，此时回送页数为0，客户端改为完整发送
+        """
+        name = info['name']
+        local = manifest.local_name(name)
+        path = os.path.join(self.save_dir, local)
+        record = journal.load(self.save_dir, local)
+        content = info.get('content')
+        if name in self.names or not os.path.isfile(path) \
+                or (record and record.info['file'] == local) \
+                or (content and self.contents.find(content['size'], content['segment'], content['md5'])):
+            size = 0  # 已有相同内容时客户端改为完整握手，由内容索引直接完成
+        else:
+            size = os.path.getsize(path)
+        block = delta.block_of(size)
+        pages = delta.pages_of(size, block)
+        message = {'type': 'message', 'data': 'signature', 'name': name, 'page': 0, 'pages': pages, 'block': block}
+        arrival = self.loop.time()
+        if not pages:
+            self.page_sender(dict(message, pages=0), header, arrival, addr)
+        for page in info['pages']:
+            if page < pages:
+                future = self.reader.submit(delta.page_of, path, block, page)
+                future.add_done_callback(functools.partial(self.page_checker, dict(message, page=page),
+                                                           header, arrival, addr))
+
+    def page_checker(self, message, header, arrival, addr, future):
+        """签名页计算完成后交由事件循环回送，旧版本已无法读取时回送页数为0。"""
+        if future.exception():
+            message['pages'] = 0
         else:
-            msg = json.dumps({'type': 'message', 'name': info['name'], 'data': 'MD5_failed'}).encode()
-            self.transport.sendto(msg, addr)
-            self.que.put({'type': 'server_info', 'message': 'MD5_failed', 'name': info['name']})
+            message['weak'], message['strong'] = future.result()
+        self.loop.call_soon_threadsafe(self.page_sender, message, header, arrival, addr)
+
+    def page_sender(self, message, header, arrival, addr):
+        """回送签名页，以请求的传输编号发送并回显其时间戳。"""
+        ts = self.loop.time()
+        self.transport.sendto(packet.pack_control(message, header.tid, ts, header.ts, ts - arrival), addr)
+
+    def crc_checker(self, path, record, parts):
+        """重读文件中的指定分块，返回与日志中的校验和不符的分块序号。"""
+        bad = []
+        chunk = record.info['chunk']
+        with open(path, 'rb') as filedata:
+            for part, crc in zip(parts, record.crcs_of(parts)):
+                filedata.seek(part * chunk)
+                if zlib.crc32(filedata.read(chunk)) != crc:
+                    bad.append(part)
+        return bad
 
     def name_checker(self, name, count=1):
         """
         同名文件检查函数。
         有同名文件就在原名后加序号直到不重名，返回新文件名
         """
-        if name in os.listdir(self.save_dir):
-            fname, ext = os.path.splitext(name)
+        if os.path.exists(os.path.join(self.save_dir, name)):
+            head, tail = os.path.split(name)  # 目录树中的文件只改文件名
+            fname, ext = os.path.splitext(tail)
             fn = fname.rsplit('_', 1)[0]
-            rename = fn + '_' + str(count) + ext
+            rename = os.path.join(head, fn + '_' + str(count) + ext)
             return self.name_checker(rename, count + 1)
         else:
             return name
 
 
-async def main(incoming_ip, bind_port, save_dir, que):
-    """服务端主函数"""
+async def main(incoming_ip, bind_port, save_dir, que, peers=None, worker=0):
+    """服务端主函数，多进程接收时以SO_REUSEPORT绑定端口，只由首个进程报告就绪"""
     loop = asyncio.get_running_loop()
     try:
         transport, protocol = await loop.create_datagram_endpoint(
-            lambda: ServerProtocol(save_dir, que, loop),
-            local_addr=(incoming_ip, bind_port))
-        que.put({'type': 'server_info', 'message': 'ready'})
+            lambda: ServerProtocol(save_dir, que, loop, peers, worker),
+            local_addr=(incoming_ip, bind_port), reuse_port=bool(peers))
+        if peers:
+            threading.Thread(target=protocol.control_receiver, daemon=True).start()
+        if not worker:
+            que.put({'type': 'server_info', 'message': 'ready'})
         await asyncio.sleep(99999999)
     except Exception as e:
         que.put({'type': 'server_info', 'message': 'error', 'detail': repr(e)})
@@ -146,5 +812,29 @@ async def main(incoming_ip, bind_port, save_dir, que):
         transport.close()
 
 
-def starter(incoming_ip, bind_port, save_dir, que):
-    asyncio.run(main(incoming_ip, bind_port, save_dir, que))
+def worker_starter(incoming_ip, bind_port, save_dir, que, peers, worker):
+    asyncio.run(main(incoming_ip, bind_port, save_dir, que, peers, worker))
+
+
+def starter(incoming_ip, bind_port, save_dir, que, workers=1):
+    """
+    服务端启动函数，workers大于1且系统支持SO_REUSEPORT时另启workers-1个接收进程，与本进程共用端口及消息队列。
+    本进程被结束时一并结束各接收进程
+    """
+    if workers <= 1 or not hasattr(socket, 'SO_REUSEPORT'):
+        asyncio.run(main(incoming_ip, bind_port, save_dir, que))
+        return
+    contents.ContentIndex(save_dir)  # 各进程启动前整理一次内容索引
+    peers = [multiprocessing.Queue() for i in range(workers)]
+    processes = [multiprocessing.Process(target=worker_starter, name='ServerWorker', daemon=True,
+                                         args=(incoming_ip, bind_port, save_dir, que, peers, worker))
+                 for worker in range(1, workers)]
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        for process in processes:
+            process.start()
+        asyncio.run(main(incoming_ip, bind_port, save_dir, que, peers, 0))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
@@ -0,0 +1,114 @@
+# coding:utf-8
+"""
+接收会话。
+接收端为每个传输保存一个会话，以(客户端IP, 传输编号)为键查找：同名文件的并发传输各自独立，
+分条发送时源端口不同的各套接字归入同一会话。
+客户端的消息至少每RTO_MAX重发一次，超过IDLE_TIMEOUT未收到数据报的会话视为客户端已离开，连同计时器及文件句柄一并清除。
+已收分块记录在位图中，与续传日志共用，各分块的校验和写在磁盘上，每个会话的内存约为分块数/8字节，
+只保留尚未写完的分块的future及一个计时器
+"""
+import rtt
+
+IDLE_TIMEOUT = 60  # 会话空闲超时(秒)
+SWEEP_INTERVAL = 5  # 空闲会话检查间隔(秒)
+TAKEOVER_ROUNDS = 4  # 客户端仍在发送时，连续超时退避此轮数才会静默到可被接管
+TAKEOVER_IDLE = 3 * rtt.RTO_MAX  # 接管所需空闲时长的上限，及新握手等待接管的最长时间(秒)
+
+
+def takeover_idle(transfer):
+    """
+    同一IP的同名同内容会话空闲超过此时长(秒)时，新的传输编号视为其续传并接管。
+    仍在发送的客户端至少每个RTO发出数据报，连续退避TAKEOVER_ROUNDS轮的静默约为RTO的2**TAKEOVER_ROUNDS倍
+    """
+    return min(transfer.rtt.rto * 2 ** TAKEOVER_ROUNDS, TAKEOVER_IDLE)
+
+
+def ranges_in(bitmap, start, end, limit):
+    """返回位图中[start, end)内已置位的区间列表[start, end)，至多limit个，全空或全满的字节整字节跳过。"""
+    ranges = []
+    part = start
+    while part < end:
+        byte = bitmap[part >> 3]
+        if part & 7 or byte not in (0, 0xff):
+            bit, step = byte >> (part & 7) & 1, 1
+        else:
+            bit, step = byte & 1, 8
+        if bit:
+            if ranges and ranges[-1][1] == part:
+                ranges[-1][1] = min(part + step, end)
+            elif len(ranges) < limit:
+                ranges.append([part, min(part + step, end)])
+            else:
+                break
+        part += step
+    return ranges
+
+
+class Session:
+    """
+    单个传输的接收状态。
+    bitmap不为None时正在接收；收齐后文件交给摘要检查线程，校验失败时可重新打开修复，结果消息送达后会话结束
+    """
+    __slots__ = ('key', 'tid', 'name', 'active', 'rtt', 'echo', 'bitmap', 'count', 'high', 'writing', 'file', 'fd',
+                 'journal', 'total', 'chunk', 'cum', 'unacked', 'timer', 'resending', 'md5', 'hashing', 'codec',
+                 'stripes', 'groups', 'repairs', 'checking', 'completed')
+
+    def __init__(self, key, name, now):
+        self.key = key  # (客户端IP, 传输编号)，客户端以新的传输编号续传时改为新键
+        self.tid = key[1]
+        self.name = name  # 客户端的文件名，回送的消息以此标识文件
+        self.active = now  # 最近收到数据报的本地时间
+        self.rtt = rtt.RttEstimator()  # 往返时延估计
+        self.echo = None  # 时间戳回显：(客户端时间戳, 收到时的本地时间)
+        self.bitmap = None  # 已接收分块的位图，即续传日志的位图
+        self.count = 0  # 已接收的分块数
+        self.high = 0  # 已接收的最大分块序号+1
+        self.writing = {}  # 尚未写完或写入失败的分块：{part: future}，写完后由写入线程移除
+        self.file = None  # 保存的文件名(相对保存目录)
+        self.fd = None  # 文件描述符，接收期间保持打开
+        self.journal = None  # 续传日志
+        self.total = 0  # 分块总数
+        self.chunk = 0  # 分块大小
+        self.cum = 0  # 累计确认：首个未收分块
+        self.unacked = 0  # 未确认的新分块数
+        self.timer = None  # 唯一的计时器：接收期间为合并确认计时器，发出结果消息后为其重发计时器
+        self.resending = False  # 计时器为结果消息的重发计时器
+        self.md5 = None  # 文件摘要：(md5, 叶摘要列表)，随摘要尾包到达，树形哈希时md5为根摘要
+        self.hashing = None  # 增量摘要：[摘要对象, 待摘要的分块序号, {乱序分块: 负载}]，摘要对象为None时收齐后重读文件
+        self.codec = None  # 握手时选定的压缩算法，为None时不压缩
+        self.stripes = 1  # 接受的分条数
+        self.groups = None  # 前向纠错：[{近期分块: 数据}, {组首分块: [组内分块数, {校验序号: 校验块}]}, 已恢复的分块数]
+        self.repairs = 0  # 已修复轮数
+        self.checking = False  # 摘要检查线程进行中，期间客户端不发送数据报，不按空闲清除
+        self.completed = False  # 已收齐，用于回送丢失的complete消息
+
+    def start(self, total, chunk, bitmap):
+        """开始接收，bitmap为续传日志的位图，已置位的分块不再接收。"""
+        self.bitmap = bitmap
+        self.count = bin(int.from_bytes(self.bitmap, 'little')).count('1')
+        self.total = total
+        self.chunk = chunk
+        self.cum = 0
+        self.advance()
+        last = len(self.bitmap.rstrip(b'\0'))  # 至末个非零字节的长度
+        self.high = max((last - 1) * 8 + self.bitmap[last - 1].bit_length() if last else 0, self.cum)
+        self.unacked = 0
+        self.completed = False
+
+    def has(self, part):
+        return self.bitmap[part >> 3] >> (part & 7) & 1
+
+    def add(self, part):
+        """记录新收到的分块并推进累计确认点。"""
+        self.bitmap[part >> 3] |= 1 << (part & 7)
+        self.count += 1
+        self.high = max(self.high, part + 1)
+        self.advance()
+
+    def advance(self):
+        while self.cum < self.total and self.has(self.cum):
+            self.cum += 1
+
+    def ranges(self, limit):
+        """返回累计确认点之后已收分块的区间列表，至多limit个。"""
+        return ranges_in(self.bitmap, self.cum, self.high, limit)
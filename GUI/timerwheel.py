@@ -0,0 +1,103 @@
+# coding:utf-8
+"""
+重发计时轮。
+同一事件循环上的全部传输共用一个分层计时轮：计时器按到期刻度放入对应层的槽中，加入及取消都是O(1)；
+计时轮只在有计时器时向事件循环登记下一个刻度，每个刻度一次处理当前槽中全部到期的计时器，
+并将上层槽中进入范围的计时器逐层下放，因此事件循环的计时堆中始终只有一项，与传输数无关。
+"""
+import weakref
+
+TICK = 0.005  # 刻度(秒)，计时器最多晚一个刻度触发，确认合并延时加一个刻度不超过rtt.ACK_DELAY_MAX
+BITS = 6  # 每层槽数为2**BITS
+LEVELS = 4  # 层数，可计时的最长延时约为TICK * 2**(BITS * LEVELS)
+SPAN = 1 << BITS * LEVELS
+MASK = (1 << BITS) - 1
+WHEELS = weakref.WeakKeyDictionary()  # 各事件循环的计时轮：{loop: TimerWheel}
+
+
+def wheel_of(loop):
+    """返回事件循环共用的计时轮，首次使用时创建。"""
+    wheel = WHEELS.get(loop)
+    if wheel is None:
+        wheel = WHEELS[loop] = TimerWheel(loop)
+    return wheel
+
+
+class Timer:
+    """计时轮中的计时器，用法同loop.call_later返回的句柄。"""
+    __slots__ = ('wheel', 'tick', 'callback', 'args', 'slot')
+
+    def __init__(self, wheel, tick, callback, args):
+        self.wheel = wheel
+        self.tick = tick  # 到期刻度
+        self.callback = callback
+        self.args = args
+        self.slot = None  # 所在的槽，已触发或已取消时为None
+
+    def cancel(self):
+        if self.slot is not None:
+            del self.slot[self]
+            self.slot = None
+            self.wheel.count -= 1
+
+
+class TimerWheel:
+    """分层计时轮：第L层的槽按到期刻度的第L段BITS位编号，计时器放在与当前刻度最高的不同段所在的层。"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.levels = [[{} for _ in range(MASK + 1)] for _ in range(LEVELS)]  # 槽为{Timer: None}，保持加入顺序
+        self.current = 0  # 已处理到的刻度
+        self.count = 0  # 计时轮中的计时器数
+        self.handle = None  # 事件循环中登记的下一个刻度，处理刻度期间仍为当前句柄
+
+    def call_later(self, delay, callback, *args):
+        """delay秒后调用callback(*args)，返回可取消的计时器。"""
+        if self.handle is None:  # 空闲后重新开始计时，不补走空闲期间的刻度
+            self.current = int(self.loop.time() / TICK)
+        tick = -int(-(self.loop.time() + delay) // TICK)  # 向上取整，不早于delay触发
+        timer = Timer(self, min(max(tick, self.current + 1), self.current + SPAN - 1), callback, args)
+        self.placer(timer)
+        self.count += 1
+        if self.handle is None:
+            self.handle = self.loop.call_at((self.current + 1) * TICK, self.ticker)
+        return timer
+
+    def placer(self, timer):
+        """将计时器放入所属层的槽中。"""
+        # 到期刻度跨过最高层的边界时放在最高层，槽号回绕，下一轮经过该槽时才下放
+        level = min(max((timer.tick ^ self.current).bit_length() - 1, 0) // BITS, LEVELS - 1)
+        slot = self.levels[level][timer.tick >> level * BITS & MASK]
+        slot[timer] = None
+        timer.slot = slot
+
+    def ticker(self):
+        """处理到当前时间为止的各刻度，仍有计时器时登记下一个刻度。"""
+        target = int(self.loop.time() / TICK)
+        while self.current < target and self.count:
+            self.current += 1
+            for level in range(LEVELS - 1, 0, -1):  # 当前刻度是第level层的段边界时，下放该层槽中的计时器
+                if not self.current & (1 << level * BITS) - 1:
+                    self.cascader(level)
+            slot = self.levels[0][self.current & MASK]
+            if slot:
+                self.levels[0][self.current & MASK] = {}
+                for timer in list(slot):
+                    if timer.slot is not slot:  # 已被同一刻度中先触发的回调取消
+                        continue
+                    self.count -= 1
+                    timer.slot = None
+                    try:
+                        timer.callback(*timer.args)
+                    except Exception as e:
+                        self.loop.call_exception_handler({'message': 'Timer callback failed', 'exception': e})
+        self.handle = self.loop.call_at((self.current + 1) * TICK, self.ticker) if self.count else None
+
+    def cascader(self, level):
+        """将第level层当前段的槽中的计时器按剩余刻度重新放入下层。"""
+        index = self.current >> level * BITS & MASK
+        slot = self.levels[level][index]
+        if slot:
+            self.levels[level][index] = {}
+            for timer in slot:
+                self.placer(timer)
@@ -1,16 +1,47 @@
 # coding:utf-8
 """
 UDP客户端，尝试连接服务端。
-当建立连接后发送指定数据。
+当建立连接后发送指定数据；发往同一服务端的全部文件共用一个事件循环及一个套接字，按传输编号区分。
+分条发送时另开若干源端口不同的套接字，同一文件的分块轮流经各套接字发出，绕开按流限速及单个接收队列的瓶颈。
 """
 import asyncio
+import collections
 import hashlib
-import json
 import os
-import random
+import socket
+import sys
+import tempfile
 import threading
 import time
 
+import bundle
+import compress
+import congestion
+import delta
+import fec
+import manifest
+import packet
+import rtt
+import timerwheel
+import treehash
+
+DUP_THRESH = 3  # 快速重发阈值：已确认分块比未确认分块晚发送的次数
+CHUNK_MAX = 65000  # 分块大小上限(字节)
+UDP_MAX = 65507  # UDP负载上限(字节)
+MTU_CANDIDATES = (65535, 9000, 1500, 1492, 1280)  # 依次探测的路径MTU
+PROBE_ROUNDS = 3  # 路径MTU探测轮数
+PMTU_CACHE = {}  # 路径MTU探测结果：{(host, port): chunk}
+FINGERPRINT_SIZE = 1048576  # 源文件指纹取首尾各此长度(字节)
+STRIPES_MAX = 8  # 分条发送的套接字数上限
+STALL_ROUNDS = 6  # 连续此数量个RTO_MAX未收到接收端任何数据报时以超时结束传输
+
+if sys.platform.startswith('linux'):  # 禁止分片的套接字选项：(level, option, value)
+    DONT_FRAGMENT = (socket.IPPROTO_IP, getattr(socket, 'IP_MTU_DISCOVER', 10), getattr(socket, 'IP_PMTUDISC_DO', 2))
+elif sys.platform == 'win32':
+    DONT_FRAGMENT = (socket.IPPROTO_IP, 14, 1)  # IP_DONTFRAGMENT
+else:
+    DONT_FRAGMENT = None
+
 
 class FilePart:
     """文件信息类"""
@@ -21,146 +52,793 @@ class FilePart:
         self.part = part
         self.total = total
         self.data = data
+        self.flags = 0  # 数据已压缩时为压缩标志
+        self.parity = None  # 组内末块随后发送的校验块：(组首分块, 组内分块数, [(校验序号, 校验块), ...])
 
 
 class ClientProtocol(asyncio.DatagramProtocol):
-    """客户端主控类。"""
+    """
+    单个传输的主控类，source为(路径, 相对路径)时发送文件，为其列表时打包发送其中的小文件，
+    为清单流时发送目录树清单，为None时发送中断消息。
+    dedup为真时先算出整个文件的摘要随握手消息发送，接收端已有相同内容时不再传输数据；
+    level不为0时与接收端协商压缩算法，以该级别逐块压缩；
+    parity不为0时每组分块附发校验块，为正数时是每组的校验块数，为-1时按丢包率自动选取；
+    lanes为分条发送的附加套接字，接收端接受时分块按序号轮流经主套接字及各附加套接字发出，控制消息只经主套接字。
+    文件传输由ClientEndpoint分发数据报并共用其套接字，结束时只通知调度器而不关闭套接字
+    """
 
-    def __init__(self, fstream, que, tc, loop):
-        self.fstream = fstream  # 文件流
+    def __init__(self, source, que, loop, window=0, cc='aimd', chunk=CHUNK_MAX, verify='md5', diff=False,
+                 dedup=False, level=0, parity=0, lanes=()):
+        self.source = source
+        self.bundled = isinstance(source, list)
+        self.listed = isinstance(source, manifest.Manifest)
+        self.patch_path = None  # 差异传输时的差异流临时文件
+        self.fstream = self.opener() if source else None  # 文件流
         self.que = que  # 客户端消息队列
-        self.tc = tc  # 多线程控制
         self.loop = loop
+        self.wheel = timerwheel.wheel_of(loop)  # 消息及分块的重发计时由同一事件循环上的传输共用
 
         self.transport = None
+        self.lanes = []  # 发送分块的套接字，首个为主套接字
         self.on_con_lost = loop.create_future()
         self.time_counter = self.loop.call_later(10, self.on_con_lost.set_result, True)
-        if fstream and tc:  # 判定是否发送中断消息
-            self.path = fstream.name
-            size = os.path.getsize(self.path)
-            total = size // 65000 + 1
-            self.gener = (FilePart(os.path.split(self.path)[1], size, i, total, fstream.read(65000))
-                          for i in range(total))
-            self.now = next(self.gener)
+        self.tid = int.from_bytes(os.urandom(4), 'big')  # 传输编号
+        self.rtt = rtt.RttEstimator()  # 往返时延估计
+        self.peer_ts = None  # 服务端最近一条消息的时间戳
+        self.peer_ts_at = 0  # 收到该消息时的本地时间
+        self.heard = loop.time()  # 最近收到接收端数据报或开始握手的本地时间
+        if self.fstream:  # 判定是否发送中断消息
+            self.chunk = chunk  # 分块大小
+            if self.bundled or self.listed:
+                self.path = None
+                self.name = self.fstream.name
+                self.names = [name for path, name in source] if self.bundled else []  # 向主进程报告结果的文件名
+                self.size = size = self.fstream.size
+                self.key = self.fstream.key
+                self.mode = None
+                self.segment = 0  # 打包流及清单不超过一个分段
+            else:
+                self.path, self.name = source  # 目录树中的文件以相对路径为名
+                self.names = [self.name]
+                self.size = size = os.path.getsize(self.path)
+                self.key = fingerprint(self.path, size)  # 源文件指纹，服务端据此判断能否续传
+                self.mode = manifest.mode_of(self.path)
+                # 树形哈希的分段长度，为0时以整个文件的MD5校验
+                self.segment = treehash.segment_of(size, chunk) if verify == 'tree' else 0
+            self.total = size // chunk + 1
+            # 差异传输时收到的旧版本签名页：{page: (弱校验和列表, 强摘要列表)}，为None时完整发送
+            self.signatures = {} if diff and self.path and size >= delta.DELTA_MIN else None
+            self.requested = list(range(delta.PAGE_BURST))  # 本批请求的签名页
+            self.patch = None  # 差异流信息：{block, md5, size}，md5及size为新文件的摘要及大小
+            # 握手消息附带的内容摘要：{size, segment, md5}，为None时不查找接收端已有的相同内容
+            self.content = {} if dedup and self.path else None
+            self.gener = None  # 分块生成器，收到握手回包后按服务端已收的分块创建
+            self.level = level  # 压缩级别，为0时不压缩
+            self.codec = None  # 接收端选定的压缩算法
+            self.parity = parity  # 前向纠错方式
+            self.grouping = False  # 接收端接受前向纠错时为True
+            self.group = (0, 0)  # 当前分组的(首块序号, 分块数)
+            self.encoder = None  # 当前分组的校验块计算对象
+            self.encoded = -1  # 最近计入校验块的分块序号
+            self.lost = 0  # 判定丢失的分块数
+            self.recovered = 0  # 接收端由校验块恢复的分块数
+            self.loss = 0.0  # 丢包率估计
+            self.sampled = (0, 0)  # 上次估计丢包率时的(发送序号, 丢失及恢复的分块数)
+            self.dup_thresh = DUP_THRESH  # 快速重发阈值，发送校验块时放宽以等待接收端恢复
+            self.spare = list(lanes)  # 分条发送的附加套接字，接收端接受后加入self.lanes
+            self.now = None  # 最近读取的分块，None表示尚未开始发送
             self.md5 = None
-            self.thread_md5 = None  # MD5计算线程
+            self.leaves = None  # 树形哈希的叶摘要
+            self.hasher = None  # 边读边算的摘要对象，续传时改由MD5计算线程读取整个文件
+            self.trailer = False  # 摘要尾包是否已发出
+            self.repair_round = 0  # 已处理的修复轮数
+
+            self.cc = congestion.controller(cc, window, chunk)  # 拥塞控制器，window不为0时为固定窗口
+            self.pacer = congestion.Pacer(loop)  # 发送节拍器
+            self.pace_timer = None  # 等待节拍的发送计时器
+            self.recover = 0  # 丢包恢复点，此前的分块丢失不再重复减窗及退避
+            self.inflight = {}  # 在途分块字典：{part: [flags, payload, timer, seq], ...}
+            self.seq = 0  # 发送序号，每次发送(含重发)递增
+            self.sacked_seq = -1  # 已确认分块中最大的发送序号
+            self.acked = 0  # 已累计确认的分块数
 
     def connection_made(self, transport):
         """连接建立时的行为。"""
         self.transport = transport
-        if self.fstream and self.tc:  # 发送文件时开始计算MD5值
-            msg = json.dumps({'type': 'message', 'data': 'established', 'name': os.path.split(self.path)[1]}).encode()
-            self.thread_md5 = threading.Thread(target=self.md5_gener)
-            self.thread_md5.start()
+        self.lanes = [transport]
+        if self.fstream and self.content is not None:  # 先算出内容摘要再握手，计算期间不计超时
+            self.time_counter.cancel()
+            threading.Thread(target=self.content_hasher).start()
+        elif self.fstream:
+            self.handshaker()
         else:  # 发送中断包
-            msg = json.dumps({'type': 'message', 'data': 'abort'}).encode()
             time.sleep(0.5)  # 防止服务端还没新建计时器实例
-        self.message_sender(msg)
+            self.message_sender({'type': 'message', 'data': 'abort'})
+
+    def handshaker(self):
+        """差异传输先请求旧版本的签名，否则发送握手消息，两者均附带内容摘要。"""
+        self.heard = self.loop.time()  # 握手前计算摘要或差异流期间不计超时
+        if self.signatures is not None:
+            msg = {'type': 'message', 'data': 'signature', 'name': self.name, 'pages': self.requested}
+            if self.content:
+                msg['content'] = self.content
+            self.message_sender(msg)
+        else:
+            self.message_sender(self.established())
+
+    def established(self):
+        """返回握手消息，差异传输时附带差异流信息。"""
+        msg = {'type': 'message', 'data': 'established', 'name': self.name, 'id': self.tid,
+               'size': self.size, 'all': self.total, 'chunk': self.chunk, 'key': self.key,
+               'segment': self.segment, 'bundle': self.bundled, 'manifest': self.listed, 'mode': self.mode}
+        if self.patch:
+            msg['delta'] = self.patch
+        if self.level:
+            msg['codecs'] = list(compress.CODECS)
+        if self.parity:
+            msg['fec'] = True
+        if self.spare:
+            msg['stripes'] = len(self.spare) + 1
+        if self.content:
+            msg['content'] = self.content
+        return msg
 
     def datagram_received(self, data, addr):
         """接收数据报时的行为。"""
-        message = json.loads(data)
+        if packet.version_of(data) != packet.VERSION or not packet.intact(data):  # 忽略不兼容及损坏的数据报
+            return
+        self.packet_received(*packet.unpack(data))
+
+    def packet_received(self, header, payload):
+        """处理已解析的数据报。"""
+        self.peer_ts = header.ts  # 记录服务端时间戳供回显
+        self.peer_ts_at = self.heard = self.loop.time()
+        if header.echo:  # 扣除服务端的合并延时后得到往返时延样本
+            self.rtt.sample(self.loop.time() - header.echo - header.hold)
+        message = packet.message_of(payload)
         if message['type'] == 'message':
             if message['data'] == 'complete':
-                if message['name'] == self.now.name:
+                if message['name'] == self.name:  # 服务端已收齐，清除全部在途分块的重发计时器
+                    for flags, payload, timer, seq in self.inflight.values():
+                        timer.cancel()
+                    self.inflight = {}
+                    if self.pace_timer:
+                        self.pace_timer.cancel()
+                    self.progress_reporter()
+            elif message['data'] == 'nak':
+                if message['name'] == self.name and message['part'] in self.inflight:  # 分块损坏，立即重发
+                    self.part_resender(message['part'])
+            elif message['data'] == 'repair':
+                if message['name'] == self.name and message['round'] > self.repair_round:
+                    # 整个文件校验失败，重新读取并发送服务端指出的损坏分块
+                    self.repair_round = message['round']
+                    self.hasher = None  # 摘要已随尾包发出
+                    self.grouping = False  # 修复时接收端不再恢复分块
+                    self.dup_thresh = DUP_THRESH
+                    self.fstream = self.opener()
+                    self.gener = self.reader(complement(message['ranges'], self.total))
+                    self.window_filler()
+            elif message['data'] == 'copying':  # 接收端正在复制已有的相同内容，照常重发握手消息等待结果
+                pass
+            elif message['data'] == 'digest_ok':
+                if message['name'] == self.name:  # 服务端已收到摘要尾包
                     self.time_counter.cancel()
             elif message['data'] == 'MD5_passed':  # 向主进程传递MD5信息并释放锁
-                self.que.put({'type': 'info', 'name': message['name'], 'message': 'MD5_passed'})
-                msg = json.dumps({'type': 'message', 'data': 'terminated'}).encode()
-                self.transport.sendto(msg)
-                self.tc.release()
-                self.fstream.close()
+                self.time_counter.cancel()
+                for name in self.names:
+                    self.que.put({'type': 'info', 'name': name, 'message': 'MD5_passed'})
+                msg = {'type': 'message', 'data': 'terminated', 'name': message['name']}
+                self.transport.sendto(packet.pack_control(msg, self.tid, *self.stamp()))
+                self.finisher()
             elif message['data'] == 'MD5_failed':
-                self.que.put({'type': 'info', 'name': message['name'], 'message': 'MD5_failed'})
-                msg = json.dumps({'type': 'message', 'data': 'terminated'}).encode()
-                self.transport.sendto(msg)
-                self.tc.release()
-                self.fstream.close()
+                self.time_counter.cancel()
+                for name in self.names:
+                    self.que.put({'type': 'info', 'name': name, 'message': 'MD5_failed'})
+                msg = {'type': 'message', 'data': 'terminated', 'name': message['name']}
+                self.transport.sendto(packet.pack_control(msg, self.tid, *self.stamp()))
+                self.finisher()
             elif message['data'] == 'get':
-                if message['part'] == self.now.part and message['name'] == self.now.name:
-                    # 接收到成功回包则更新进度条消息并发送下一个包
+                if message['name'] == self.name and self.gener is None:
+                    # 接收到握手回包后跳过服务端已收的分块，开始填充发送窗口
                     self.time_counter.cancel()
-                    self.que.put({'type': 'prog', 'name': message['name'], 'part': message['part']})
-                    try:
-                        self.file_sender()
-                        self.now = next(self.gener)
-                    except StopIteration:
-                        self.fstream.close()
+                    if self.md5:  # 摘要已在握手前算出
+                        pass
+                    elif message['ranges']:  # 续传时跳过的分块不会被读取，由MD5计算线程读取整个文件
+                        threading.Thread(target=self.md5_gener).start()
+                    else:  # 分块读取时顺带计算摘要，只读一遍文件
+                        self.hasher = treehash.TreeHasher(self.segment) if self.segment else hashlib.md5()
+                    self.codec = message.get('codec') if self.level else None  # 旧版本接收端不回送压缩算法
+                    self.grouping = bool(self.parity and message.get('fec'))
+                    self.lanes = self.lanes[:1] + self.spare[:message.get('stripes', 1) - 1]
+                    self.gener = self.reader(message['ranges'])
+                    self.window_filler()
+            elif message['data'] == 'signature':
+                if message['name'] == self.name and self.signatures is not None:
+                    self.signature_receiver(message)
+            elif message['data'] == 'sack':
+                if message['name'] == self.name:
+                    self.recovered = max(self.recovered, message.get('recovered', 0))
+                    self.sack_handler(message['cum'], message['ranges'])
+            elif message['data'] == 'rejected' and self.fstream:  # 服务端协议版本不兼容
+                for name in self.names:
+                    self.que.put({'type': 'info', 'name': name, 'message': 'rejected'})
+                self.finisher()
             elif message['data'] == 'aborted':
-                self.time_counter.cancel()
                 self.que.put({'type': 'info', 'message': 'aborted', 'name': 'None'})
-                self.transport.close()
+                self.finisher()
+            elif message['data'] == 'reset':
+                if self.fstream and self.gener is not None:  # 接收端已清除会话，首个重置消息之后的忽略
+                    self.resetter()
+
+    def resetter(self):
+        """
+        接收端因长时间收不到数据报已清除本传输的会话：放弃在途分块，以同一传输编号重新握手，
+        接收端按续传日志回送已收分块，摘要尾包在末块重发后再次发送
+        """
+        if self.pace_timer:
+            self.pace_timer.cancel()
+            self.pace_timer = None
+        for flags, payload, timer, seq in self.inflight.values():
+            timer.cancel()
+        self.inflight = {}
+        self.gener = self.now = self.encoder = None
+        self.encoded = -1
+        if not self.md5:  # 续传时跳过的分块不会被读取，由MD5计算线程读取整个文件
+            self.hasher = None
+        self.trailer = False
+        self.fstream.close()
+        self.fstream = self.opener()
+        self.message_sender(self.established())
 
     def connection_lost(self, exc):
         """连接断开时的行为。"""
+        self.finisher()
+
+    def signature_receiver(self, message):
+        """
+        收集旧版本的签名页，本批请求的各页收齐后请求下一批，全部收齐后由线程生成差异流。
+        服务端没有可用的旧版本时改为完整发送
+        """
+        if not message['pages']:
+            self.signatures = None
+            self.message_sender(self.established())
+            return
+        strong = bytes.fromhex(message['strong'])
+        self.signatures[message['page']] = (message['weak'], [strong[i:i + delta.STRONG_SIZE]
+                                                              for i in range(0, len(strong), delta.STRONG_SIZE)])
+        missing = [page for page in range(message['pages']) if page not in self.signatures]
+        if not missing:
+            self.time_counter.cancel()
+            signatures, self.signatures = self.signatures, None
+            threading.Thread(target=self.delta_maker, args=(signatures, message['block'])).start()
+        elif all(page in self.signatures for page in self.requested if page < message['pages']):
+            self.requested = missing[:delta.PAGE_BURST]
+            self.message_sender({'type': 'message', 'data': 'signature', 'name': self.name, 'pages': self.requested})
+
+    def delta_maker(self, signatures, block):
+        """由签名页生成差异流写入临时文件，完成后交由事件循环改为发送差异流，出错时报告失败。"""
+        weak, strong = [], []
+        for page in sorted(signatures):
+            weak += signatures[page][0]
+            strong += signatures[page][1]
+        path = None
+        try:
+            fd, path = tempfile.mkstemp(suffix=delta.SUFFIX)
+            with os.fdopen(fd, 'wb') as out:
+                md5 = delta.delta_gener(self.path, block, weak, strong, out)
+        except Exception:
+            if path:
+                os.remove(path)
+            self.thread_failed()
+            return
+        # 差异流指纹：同一新文件对同一旧版本生成的差异流相同，可续传
+        key = hashlib.md5('{0}{1}{2}'.format(md5, block, hashlib.md5(b''.join(strong)).hexdigest()).encode())
+        if self.loop.is_closed():
+            os.remove(path)
+        else:
+            self.loop.call_soon_threadsafe(self.delta_starter, path, {'block': block, 'md5': md5, 'size': self.size},
+                                           key.hexdigest())
+
+    def delta_starter(self, path, patch, key):
+        """改为发送差异流：按差异流的大小分块并发送握手消息。"""
+        self.patch, self.patch_path = patch, path
+        if self.on_con_lost.done():  # 生成差异流期间传输已结束
+            self.finisher()
+            return
+        self.fstream.close()
+        self.fstream = self.opener()
+        self.size = os.path.getsize(path)
+        self.total = self.size // self.chunk + 1
+        self.key = key
+        self.segment = 0
+        self.md5 = self.leaves = None  # 尾包的摘要改为差异流的摘要
+        self.handshaker()
+
+    def finisher(self):
+        """传输结束：清除全部计时器、关闭文件并通知等待方，共用的套接字由其所有者关闭。"""
+        self.time_counter.cancel()
         if self.fstream:
             self.fstream.close()
-        self.on_con_lost.set_result(True)
+            if self.pace_timer:
+                self.pace_timer.cancel()
+            for flags, payload, timer, seq in self.inflight.values():
+                timer.cancel()
+            self.inflight = {}
+            if self.patch_path:
+                try:
+                    os.remove(self.patch_path)
+                except OSError:
+                    pass
+        if not self.on_con_lost.done():
+            self.on_con_lost.set_result(True)
 
-    def file_sender(self):
-        """数据报的发送行为。"""
-        if self.md5:
-            raw_msg = {'type': 'data', 'name': self.now.name, 'size': self.now.size, 'part': self.now.part,
-                       'all': self.now.total, 'md5': self.md5}
+    def window_filler(self):
+        """在窗口允许的范围内按节拍读取并发送新分块，未到发送时间则定时再次填充。"""
+        self.pace_timer = None
+        while len(self.inflight) < int(self.cc.cwnd):
+            delay = self.pacer.delay()
+            if delay > 0:
+                self.pace_timer = self.loop.call_later(delay, self.window_filler)
+                break
+            if self.codec and self.gener.waiting(int(self.cc.cwnd), self.pipeline_waker):  # 等待队首分块压缩完成
+                break
+            try:
+                self.now = next(self.gener)
+            except StopIteration:
+                self.fstream.close()
+                break
+            # 本次填满窗口的分块要求服务端立即确认，避免小窗口等待合并延时
+            self.file_sender(len(self.inflight) + 1 >= int(self.cc.cwnd))
+            self.pacer.sent(self.cc.interval(self.rtt))
+
+    def pipeline_waker(self):
+        """队首分块压缩完成时由压缩线程调用，交由事件循环继续填充窗口。"""
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.pipeline_woken)
+
+    def pipeline_woken(self):
+        if not self.on_con_lost.done() and not self.pace_timer and self.gener is not None:
+            self.window_filler()
+
+    def reader(self, ranges):
+        """返回分块迭代器，协商了压缩算法时经由压缩流水线。"""
+        parts = self.part_reader(ranges)
+        return compress.Pipeline(parts, self.codec, self.level, packet.FLAG_COMPRESSED) if self.codec else parts
+
+    def part_reader(self, ranges):
+        """按序读取分块，跳过区间列表[start, end)内服务端已收的分块。"""
+        part = 0
+        for start, end in sorted(ranges) + [[self.total, self.total]]:
+            if part < start:
+                self.fstream.seek(part * self.chunk)
+                for i in range(part, start):
+                    data = self.fstream.read(self.chunk)
+                    if self.hasher:
+                        self.hasher.update(data)
+                        if i + 1 == self.total:
+                            self.md5 = self.hasher.hexdigest()
+                            if self.segment:
+                                self.leaves = self.hasher.leaves()
+                    item = FilePart(self.name, self.size, i, self.total, data)
+                    if self.grouping:
+                        item.parity = self.parity_feeder(i, data)
+                    yield item
+            part = max(part, end)
+
+    def parity_feeder(self, part, data):
+        """
+        将新读取的分块计入所在组的校验块，组内末块返回(组首分块, 组内分块数, 校验块列表)，否则返回None。
+        每组的分块数及校验块数在组首按当时的拥塞窗口及丢包率选取，跳过服务端已收的分块时另起一组
+        """
+        if not self.encoder or self.encoded != part - 1:
+            count = min(fec.group_of(self.cc.cwnd), self.total - part)
+            parity = self.parity if self.parity > 0 else fec.parity_of(self.loss_rate(), count)
+            self.encoder = fec.Encoder(parity, self.chunk) if parity else None
+            self.group = (part, count)
+            # 丢失的分块须等到组内末块及校验块到达后才能恢复，其间不按乱序判定丢失
+            self.dup_thresh = DUP_THRESH + count if parity else DUP_THRESH
+        self.encoded = part
+        if not self.encoder:
+            return None
+        self.encoder.update(data)
+        if part + 1 < sum(self.group):
+            return None
+        parities, self.encoder = self.encoder.parities(), None
+        return self.group + (parities,)
+
+    def loss_rate(self):
+        """由上次估计以来丢失及被恢复的分块占发送分块的比例更新丢包率估计(指数加权平均)。"""
+        sent, lost = self.seq, self.lost + self.recovered
+        if sent >= self.sampled[0] + fec.LOSS_SAMPLE:
+            self.loss += ((lost - self.sampled[1]) / (sent - self.sampled[0]) - self.loss) / 4
+            self.sampled = (sent, lost)
+        return self.loss
+
+    def sack_handler(self, cum, ranges):
+        """
+        处理选择确认消息：移出累计确认及区间内的在途分块，扩大窗口并继续填充。
+        比最新确认分块早发送DUP_THRESH次以上的未确认分块视为丢失，立即重发
+        """
+        sacked = [part for part in self.inflight
+                  if part < cum or any(start <= part < end for start, end in ranges)]
+        for part in sacked:
+            flags, payload, timer, seq = self.inflight.pop(part)
+            timer.cancel()
+            self.sacked_seq = max(self.sacked_seq, seq)
+        if sacked:
+            self.cc.on_ack(len(sacked), self.rtt)
+        for part in [part for part in self.inflight if self.inflight[part][3] + self.dup_thresh <= self.sacked_seq]:
+            self.part_lost(part)
+        if not self.pace_timer:
+            self.window_filler()
+        self.progress_reporter()
+
+    def progress_reporter(self):
+        """累计确认的分块数增加时向主进程发送进度消息。"""
+        if self.inflight:
+            acked = min(self.inflight)
         else:
-            # MD5未计算完成则判定当前是否为末块：
-            # 是则等待MD5计算，不是则继续发送
-            if self.now.part + 1 == self.now.total:
-                self.thread_md5.join()
-                raw_msg = {'type': 'data', 'name': self.now.name, 'size': self.now.size, 'part': self.now.part,
-                           'all': self.now.total, 'md5': self.md5}
-            else:
-                raw_msg = {'type': 'data', 'name': self.now.name, 'size': self.now.size, 'part': self.now.part,
-                           'all': self.now.total}
-        fdata = json.dumps(raw_msg).encode() + b'---+++data+++---' + self.now.data
-        self.message_sender(fdata)
+            acked = self.now.part + 1
+        if acked > self.acked:
+            self.acked = acked
+            if not (self.bundled or self.listed):
+                self.que.put({'type': 'prog', 'name': self.name, 'part': acked - 1, 'all': self.total,
+                              'rtt': self.rtt.status()})
+            elif acked == self.total:  # 打包的文件全部确认后一并报告
+                for name in self.names:
+                    self.que.put({'type': 'prog', 'name': name, 'part': 0, 'all': 1, 'rtt': self.rtt.status()})
+
+    def file_sender(self, ack_now=False):
+        """数据报的发送行为。"""
+        flags = (packet.FLAG_ACK_NOW if ack_now else 0) | self.now.flags
+        self.part_sender(flags, self.now.data, self.now.part)
+        if self.now.parity and self.grouping:  # 组内末块发出后发送校验块，不重发
+            start, count, parities = self.now.parity
+            for index, data in parities:
+                self.lanes[(start + index) % len(self.lanes)].sendto(
+                    packet.pack_parity(self.tid, start, count, index, *self.stamp(), data))
+                self.pacer.sent(self.cc.interval(self.rtt))
+        if self.now.part + 1 == self.now.total:  # 末块发出后发送摘要尾包
+            self.trailer_sender()
+
+    def trailer_sender(self):
+        """末块已发出且MD5已算出时发送摘要尾包，两者中后完成的一方触发。"""
+        if self.md5 and self.now and self.now.part + 1 == self.total and not self.trailer \
+                and not self.on_con_lost.done():
+            self.trailer = True
+            self.message_sender({'type': 'message', 'data': 'digest', 'name': self.name, 'md5': self.md5,
+                                 'leaves': self.leaves})
+
+    def stamp(self):
+        """返回(发送时间戳, 服务端时间戳的回显, 回显前的停留时间)，供双方测量往返时延。"""
+        ts = self.loop.time()
+        if self.peer_ts is None:
+            return ts, 0.0, 0.0
+        return ts, self.peer_ts, ts - self.peer_ts_at
 
     def message_sender(self, message):
         """
-        自带随机秒重发机制的消息回发(0.1-0.3s)。
-        传入参数必须用json打包
+        自带超时重发机制的消息发送，超时时间由往返时延估计得出。
+        传入参数为未打包的消息字典，每次发送时重新打包以更新时间戳
         """
         self.time_counter.cancel()
-        self.transport.sendto(message)
-        self.time_counter = self.loop.call_later(random.uniform(0.1, 0.3), self.message_sender, message)
+        self.transport.sendto(packet.pack_control(message, self.tid, *self.stamp()))
+        self.time_counter = self.wheel.call_later(self.rtt.rto, self.message_timeout, message)
 
-    def md5_gener(self):
+    def message_timeout(self, message):
+        """消息超时：退避重发超时后重发。"""
+        if self.stall_checker():
+            return
+        self.rtt.timeout()
+        self.message_sender(message)
+
+    def part_sender(self, flags, payload, part):
+        """自带超时重发机制的分块发送，每个在途分块各自计时，分条发送时按分块序号选取套接字。"""
+        self.lanes[part % len(self.lanes)].sendto(packet.pack_data(self.tid, part, flags, *self.stamp(), payload))
+        timer = self.wheel.call_later(self.rtt.rto, self.part_timeout, part)
+        self.inflight[part] = [flags, payload, timer, self.seq]
+        self.seq += 1
+
+    def part_timeout(self, part):
+        """分块超时：每轮丢包只退避一次重发超时，然后按丢失重发。"""
+        if self.stall_checker():
+            return
+        if part >= self.recover:
+            self.rtt.timeout()
+        self.part_lost(part)
+
+    def stall_checker(self):
+        """超时重发前检查接收端是否已离开：STALL_ROUNDS个RTO_MAX内未收到任何数据报时以超时结束传输。"""
+        if self.loop.time() - self.heard < STALL_ROUNDS * rtt.RTO_MAX:
+            return False
+        if self.fstream:
+            for name in self.names:
+                self.que.put({'type': 'info', 'name': name, 'message': 'timeout'})
+        self.finisher()
+        return True
+
+    def part_lost(self, part):
+        """分块被判定丢失时立即重发(不受节拍限制)，每轮丢包只通知拥塞控制器一次。"""
+        self.lost += 1
+        if part >= self.recover:
+            self.cc.on_loss()
+            self.recover = self.now.part + 1
+        self.part_resender(part)
+
+    def part_resender(self, part):
+        """立即重发在途分块。"""
+        flags, payload, timer, seq = self.inflight[part]
+        timer.cancel()
+        self.part_sender(flags, payload, part)
+
+    def opener(self):
+        """打开文件流，打包发送时为打包流，发送目录树清单时为清单流，差异传输时为差异流。"""
+        if self.patch_path:
+            return open(self.patch_path, 'rb')
+        if self.bundled:
+            return bundle.Bundle(self.source)
+        if self.listed:
+            return manifest.Manifest(self.source.entries)
+        return open(self.source[0], 'rb')
+
+    def digest_of(self):
+        """读取整个文件流计算摘要，返回(摘要, 叶摘要列表)，树形哈希由线程池并行计算各分段。"""
+        if self.segment:
+            return treehash.tree_hash(self.path, self.segment)
         md5 = hashlib.md5()
-        with open(self.path, 'rb') as f:
-            for line in f:
-                md5.update(line)
-        self.md5 = md5.hexdigest()
+        with self.opener() as f:
+            for block in iter(lambda: f.read(self.chunk), b''):
+                md5.update(block)
+        return md5.hexdigest(), None
 
+    def md5_gener(self):
+        """续传时由线程计算摘要，完成后发送摘要尾包，出错时报告失败。"""
+        try:
+            self.md5, self.leaves = self.digest_of()
+        except Exception:
+            self.thread_failed()
+            return
+        if not self.loop.is_closed():  # 传输已被拒绝或中断时事件循环可能已结束
+            self.loop.call_soon_threadsafe(self.trailer_sender)
 
-async def main(host, port, path, threading_controller, que):
-    """传输控制主函数，传输端点在此关闭。"""
-    loop = asyncio.get_running_loop()
-    if path and threading_controller:  # 正常传输
-        threading_controller.acquire()
-        fstream = open(path, 'rb')
-        transport, protocol = await loop.create_datagram_endpoint(
-            lambda: ClientProtocol(fstream, que, threading_controller, loop),
-            remote_addr=(host, port))
-    else:  # 中断传输
-        transport, protocol = await loop.create_datagram_endpoint(
-            lambda: ClientProtocol(None, que, None, loop),
-            remote_addr=(host, port))
+    def content_hasher(self):
+        """握手前由线程计算整个文件的摘要，完成后交由事件循环开始握手，出错时报告失败。"""
+        try:
+            md5, leaves = self.digest_of()
+        except Exception:
+            self.thread_failed()
+            return
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.content_starter, md5, leaves)
+
+    def thread_failed(self):
+        """读取文件的线程出错(如文件已被删除)，交由事件循环结束传输。"""
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.failer)
+
+    def failer(self):
+        """向主进程报告各文件出错并结束传输，传输已结束时忽略。"""
+        if self.on_con_lost.done():
+            return
+        for name in self.names:
+            self.que.put({'type': 'info', 'name': name, 'message': 'error'})
+        self.finisher()
+
+    def content_starter(self, md5, leaves):
+        """以内容摘要开始握手，接收端没有相同内容时照常传输，发送时不必再算摘要。"""
+        if self.on_con_lost.done():  # 计算摘要期间传输已结束
+            return
+        self.content = {'size': self.size, 'segment': self.segment, 'md5': md5}
+        self.md5, self.leaves = md5, leaves
+        self.handshaker()
+
+
+class ClientEndpoint(asyncio.DatagramProtocol):
+    """
+    发往同一服务端的共用套接字：按头部的传输编号将数据报分发给各传输，
+    并调度文件的开始顺序，同时进行的传输数不超过上限，排队的文件不占用线程及传输状态
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = None
+        self.transfers = {}  # 进行中的传输：{tid: ClientProtocol}
+        self.lanes = []  # 分条发送的附加套接字
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if packet.version_of(data) != packet.VERSION or not packet.intact(data):  # 忽略不兼容及损坏的数据报
+            return
+        header, payload = packet.unpack(data)
+        if header.tid in self.transfers:
+            self.transfers[header.tid].packet_received(header, payload)
+        elif not header.tid:  # 不属于具体传输的消息(如版本不兼容)交给全部传输
+            for transfer in list(self.transfers.values()):
+                transfer.packet_received(header, payload)
+        else:
+            message = packet.message_of(payload)
+            if message.get('data') in ('MD5_passed', 'MD5_failed'):  # 已结束的传输的terminated消息丢失
+                msg = {'type': 'message', 'data': 'terminated', 'name': message['name']}
+                self.transport.sendto(packet.pack_control(msg, header.tid, self.loop.time(), header.ts, 0.0))
+
+    async def scheduler(self, paths, limit, factory):
+        """按列表顺序开始各文件的传输，有传输结束时开始下一个，factory由路径创建传输，无法创建时返回None并跳过。"""
+        pending = collections.deque(paths)
+        active = {}  # {传输结束的future: 传输}
+        while pending or active:
+            while pending and len(active) < limit:
+                transfer = factory(pending.popleft())
+                if transfer is None:
+                    continue
+                self.transfers[transfer.tid] = transfer
+                active[transfer.on_con_lost] = transfer
+                transfer.connection_made(self.transport)
+            done, _ = await asyncio.wait(active, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                self.transfers.pop(active.pop(future).tid)
+
+
+class LaneEndpoint(asyncio.DatagramProtocol):
+    """分条发送的附加套接字：接收端对经此发出的分块的确认也回到此处，交给主套接字的ClientEndpoint分发。"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+    def datagram_received(self, data, addr):
+        self.endpoint.datagram_received(data, addr)
+
+
+class ProbeProtocol(asyncio.DatagramProtocol):
+    """路径MTU探测类：发送禁止分片的各尺寸探测包，记录服务端确认的最大尺寸。"""
+
+    def __init__(self, loop, sizes):
+        self.loop = loop
+        self.sizes = sizes  # 探测包尺寸，从大到小
+        self.acked = 0  # 已确认的最大尺寸
+        self.sent_at = 0  # 最近一轮探测的发送时间
+        self.rtt = None  # 首个确认的往返时延
+        self.transport = None
+        self.done = loop.create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock.family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_DONTFRAG, 1)
+        else:
+            sock.setsockopt(*DONT_FRAGMENT)
+
+    def datagram_received(self, data, addr):
+        if packet.version_of(data) != packet.VERSION or not packet.intact(data):
+            return
+        header, payload = packet.unpack(data)
+        message = packet.message_of(payload)
+        if message['type'] == 'message' and message['data'] == 'probe_ack':
+            self.acked = max(self.acked, message['size'])
+            if self.rtt is None:
+                self.rtt = self.loop.time() - self.sent_at
+            if self.acked == self.sizes[0] and not self.done.done():
+                self.done.set_result(True)
+
+    def error_received(self, exc):
+        """超过本地接口MTU的探测包发送失败，忽略即可。"""
+        pass
+
+    def prober(self):
+        """发送一轮探测包，已确认尺寸及以下的不再探测。"""
+        self.sent_at = self.loop.time()
+        for size in self.sizes:
+            if size > self.acked:
+                self.transport.sendto(packet.pack_probe(size))
+
+
+def complement(ranges, total):
+    """返回[0, total)中不在区间列表内的部分，同为区间列表。"""
+    result = []
+    part = 0
+    for start, end in sorted(ranges):
+        if part < start:
+            result.append([part, start])
+        part = max(part, end)
+    if part < total:
+        result.append([part, total])
+    return result
+
+
+def fingerprint(path, size):
+    """计算源文件指纹：文件大小及首尾各FINGERPRINT_SIZE字节的MD5，不必读完整个文件。"""
+    md5 = hashlib.md5(str(size).encode())
+    with open(path, 'rb') as f:
+        md5.update(f.read(FINGERPRINT_SIZE))
+        if size > FINGERPRINT_SIZE:
+            f.seek(max(size - FINGERPRINT_SIZE, FINGERPRINT_SIZE))
+            md5.update(f.read())
+    return md5.hexdigest()
+
+
+def chunk_of(size):
+    """由不分片的最大UDP负载换算分块大小，扣除头部。"""
+    return min(size - packet.HEADER.size, CHUNK_MAX)
+
+
+async def mtu_prober(loop, host, port):
+    """探测到服务端的路径MTU，返回数据报不会被分片的分块大小。"""
+    info = await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+    overhead = 48 if info[0][0] == socket.AF_INET6 else 28  # IP及UDP头部长度
+    sizes = [min(mtu - overhead, UDP_MAX) for mtu in MTU_CANDIDATES]
+    if not DONT_FRAGMENT:  # 无法禁止分片的平台按以太网MTU计算
+        return chunk_of(1500 - overhead)
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: ProbeProtocol(loop, sizes), remote_addr=(host, port))
+    wait = rtt.RTO_INIT
     try:
-        await protocol.on_con_lost
+        for i in range(PROBE_ROUNDS):
+            protocol.prober()
+            try:
+                await asyncio.wait_for(asyncio.shield(protocol.done), wait)
+            except asyncio.TimeoutError:
+                pass
+            if protocol.rtt is not None:  # 已有确认时更大的探测包只需再等待数个往返时延，防止随机丢包误判
+                wait = max(2 * protocol.rtt, rtt.RTO_MIN)
     finally:
         transport.close()
+    return chunk_of(protocol.acked or sizes[-1])
+
+
+async def main(host, port, paths, file_at_same_time, que, window=0, cc='aimd', chunk=0, verify='md5', bundled=False,
+               diff=False, dedup=False, level=0, parity=0, stripes=1):
+    """
+    传输控制主函数，传输端点在此关闭。
+    paths中的目录展开后连同目录树清单发送，paths为空时发送中断消息，bundled为真时打包发送小文件，
+    diff为真时接收端已有的同名文件按差异传输，dedup为真时接收端已有相同内容的文件不再传输，
+    level不为0时以该级别压缩分块，parity不为0时发送前向纠错的校验块，stripes大于1时每个文件分条经多个套接字发送
+    """
+    loop = asyncio.get_running_loop()
+    if paths and file_at_same_time:  # 正常传输
+        if not chunk:  # 自动分块大小：探测路径MTU，同一接收端只探测一次
+            if (host, port) not in PMTU_CACHE:
+                PMTU_CACHE[(host, port)] = await mtu_prober(loop, host, port)
+            chunk = PMTU_CACHE[(host, port)]
+        transport, endpoint = await loop.create_datagram_endpoint(
+            lambda: ClientEndpoint(loop), remote_addr=(host, port))
+        try:
+            for i in range(min(stripes, STRIPES_MAX) - 1):  # 各附加套接字由系统分配不同的源端口
+                lane, _ = await loop.create_datagram_endpoint(
+                    lambda: LaneEndpoint(endpoint), remote_addr=(host, port))
+                endpoint.lanes.append(lane)
+            files, entries = manifest.walker(paths)
+            sources = bundle.grouper(files) if bundled else files
+            if entries:  # 目录树清单最先发送
+                sources.insert(0, manifest.Manifest(entries))
+
+            def creator(source):
+                """创建单个源的传输，源文件无法读取时报告该源的各文件出错并返回None，不影响其余文件。"""
+                try:
+                    return ClientProtocol(source, que, loop, window, cc, chunk, verify, diff, dedup, level, parity,
+                                          endpoint.lanes)
+                except OSError:
+                    for path, name in (source if isinstance(source, list) else [source]):
+                        que.put({'type': 'info', 'name': name, 'message': 'error'})
+                    return None
+
+            await endpoint.scheduler(sources, file_at_same_time, creator)
+        finally:
+            for lane in endpoint.lanes:
+                lane.close()
+            transport.close()
+    else:  # 中断传输
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: ClientProtocol(None, que, loop), remote_addr=(host, port))
+        try:
+            await protocol.on_con_lost
+        finally:
+            transport.close()
 
 
-def starter(host, port, file, file_at_same_time, que):
-    """传输线程启动函数。"""
-    if file and file_at_same_time:
-        threading_controller = threading.BoundedSemaphore(value=file_at_same_time)
-        for path in file:
-            thread_asyncio = threading.Thread(target=asyncio.run,
-                                              args=(main(host, port, path, threading_controller, que),))
-            thread_asyncio.start()
-    else:
-        thread_asyncio = threading.Thread(target=asyncio.run,
-                                          args=(main(host, port, [], None, que),))
-        thread_asyncio.start()
-    thread_asyncio.join()
+def starter(host, port, file, file_at_same_time, que, window=0, cc='aimd', chunk=0, verify='md5', bundled=False,
+            diff=False, dedup=False, level=0, parity=0, stripes=1):
+    """传输启动函数，全部文件在同一个事件循环中传输。"""
+    asyncio.run(main(host, port, file, file_at_same_time, que, window, cc, chunk, verify, bundled, diff, dedup,
+                     level, parity, stripes))
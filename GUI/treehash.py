@@ -0,0 +1,84 @@
+# coding:utf-8
+"""
+分段树形哈希。
+文件按固定长度分段，各段的MD5为叶摘要，全部叶摘要连接后的MD5为根摘要。
+各段互不依赖，重读文件时可由线程池在多个核心上同时计算；校验失败时比较叶摘要即可找出损坏的分段。
+"""
+import concurrent.futures
+import hashlib
+import os
+
+SEGMENT_MIN = 16777216  # 分段长度下限(字节)
+TREE_LEAVES = 256  # 叶摘要数上限，使全部叶摘要能放入一个控制消息
+READ_BLOCK = 1048576  # 读取文件时的块大小(字节)
+
+
+def segment_of(size, chunk):
+    """按文件大小选取分段长度，取分块大小的整数倍以便分段与分块对齐。"""
+    segment = max(SEGMENT_MIN, -(-size // TREE_LEAVES))
+    return -(-segment // chunk) * chunk
+
+
+def root_of(leaves):
+    """由十六进制叶摘要列表计算根摘要。"""
+    return hashlib.md5(b''.join(bytes.fromhex(leaf) for leaf in leaves)).hexdigest()
+
+
+class TreeHasher:
+    """按顺序输入数据的树形哈希类，接口与hashlib的摘要对象一致。"""
+
+    def __init__(self, segment):
+        self.segment = segment
+        self.md5 = hashlib.md5()  # 当前分段的摘要
+        self.filled = 0  # 当前分段已输入的长度
+        self.done = []  # 已完成分段的叶摘要
+
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            piece = data[:self.segment - self.filled]
+            self.md5.update(piece)
+            self.filled += len(piece)
+            data = data[len(piece):]
+            if self.filled == self.segment:
+                self.done.append(self.md5.hexdigest())
+                self.md5 = hashlib.md5()
+                self.filled = 0
+
+    def leaves(self):
+        """返回全部叶摘要，未满的末段也计入。"""
+        if self.filled or not self.done:
+            return self.done + [self.md5.hexdigest()]
+        return list(self.done)
+
+    def hexdigest(self):
+        return root_of(self.leaves())
+
+
+def digest_of(hasher):
+    """返回摘要对象的(根摘要, 叶摘要列表)，MD5对象没有叶摘要。"""
+    if isinstance(hasher, TreeHasher):
+        return hasher.hexdigest(), hasher.leaves()
+    return hasher.hexdigest(), None
+
+
+def leaf_of(path, offset, segment):
+    """计算文件中一个分段的叶摘要。"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while segment > 0:
+            block = f.read(min(READ_BLOCK, segment))
+            if not block:
+                break
+            md5.update(block)
+            segment -= len(block)
+    return md5.hexdigest()
+
+
+def tree_hash(path, segment):
+    """以线程池并行计算整个文件的树形哈希，返回(根摘要, 叶摘要列表)。"""
+    count = max(-(-os.path.getsize(path) // segment), 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        leaves = list(pool.map(lambda i: leaf_of(path, i * segment, segment), range(count)))
+    return root_of(leaves), leaves
@@ -4,7 +4,8 @@
 '''
 import os, time, json, asyncio, hashlib
 
-file = os.listdir('send')
+# 递归发送send目录树，文件名为含目录的相对路径，服务端据此重建目录
+file = [os.path.join(top, name) for top, dirs, names in os.walk('send') for name in names]
 part = 0
 # 网速M/s
 net = 4
@@ -4,8 +4,10 @@ UDP客户端，尝试连接服务端。
 当建立连接后发送指定数据。
 '''
 import os, threading, json, asyncio, hashlib, random
-file = os.listdir('send')
+# 递归发送send目录树，文件名为含目录的相对路径，服务端据此重建目录
+file = [os.path.join(top, name) for top, dirs, names in os.walk('send') for name in names]
 file_at_same_time = 2
+chunk_size = 65000  # 单块大小，超过路径MTU的数据报会被IP分片
 error = []
 ip = '192.168.1.4'
 
@@ -31,8 +33,8 @@ def display_file_length(file_size):
 def file_spliter(f):
     '''返回数据块的生成器（单块限定64K）'''
     size = os.path.getsize(f.name)
-    all = size // 65000 + 1
-    data = (FilePart(f.name, size, i, all, f.read(65000)) for i in range(all))
+    all = size // chunk_size + 1
+    data = (FilePart(f.name, size, i, all, f.read(chunk_size)) for i in range(all))
     return data
 
 class ClientProtocol:
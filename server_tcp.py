@@ -27,6 +27,8 @@ async def trans_data(reader, writer):
     # 接收完一块后发送已接受信号
     #writer.write(b'---+++received+++---')
     info = json.loads(data.split(b'---+++header+++---')[0])
+    if os.path.dirname(info['name']):  # 建立目录树中的上级目录
+        os.makedirs(os.path.dirname(info['name']), exist_ok=True)
     with open(info['name'] + '.part' + str(info['part']), 'wb') as transchunk:
         transchunk.write(data.split(b'---+++header+++---')[1])
     if info['name'] not in status:
@@ -55,6 +55,8 @@ class ServerProtocol:
     
     def write_data(self, info, data, addr):
         '''写入本地数据并回发get消息'''
+        if os.path.dirname(info['name']):  # 建立目录树中的上级目录
+            os.makedirs(os.path.dirname(info['name']), exist_ok=True)
         with open(info['name'], 'ab') as filedata:
             filedata.write(data)
         print('{0}(part {1}/{2}) complete.'.format(info['name'], info['part'] + 1, info['all']), end='\n')